@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Reads the index sidecar files that wood.py and colormix.py write beside a g-code file with --index, for the other
+# tools of a print farm (the index is checked against the g-code file, and is not used when that one changed).
+#
+# Run it like:
+#   gcodeindex.py --file print.gcode (--layers)
+#
+# The index of print.gcode is print.gcode.gcidx, made of (all little-endian):
+#   a header: b'GCIX', the version (uint16), whether the end of lines are \r\n (uint8), whether the slicer settings
+#     enable the spiral (vase) mode (uint8), then the key of the g-code file: its size (uint64), its modification
+#     time (int64, in ns) and the CRC32 of its first and last MB (uint32, see index_key()), then the highest Z of the
+#     moves (double), the height announced by the slicer when the last moves confirm it (double, 0 if unknown) and
+#     the count of Z values (uint32)
+#   the successive Z of the moves, without repeats (doubles)
+#   the offsets of the first move at each of these Z in the file, once unpacked (uint64)
+#   whether each of these Z is only a hop, i.e. the next Z goes back to the former one (uint8)
+#
+# The arrays are memory-mapped, nothing is read before it is used.
+
+import sys
+import os
+import getopt
+import inspect
+import struct
+import zlib
+import mmap
+
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+INDEX_MAGIC = b'GCIX'
+INDEX_VERSION = 1
+# magic, version, crlf, spiral, size, mtime (ns), hash, maxZ, slicer maxZ (0 if unknown), count of Z
+INDEX_HEADER = struct.Struct('<4sHBBQqIddI')
+INDEX_HASH_SPAN = 1 << 20  # bytes hashed at each end of the g-code file
+
+
+class GcodeIndex:
+    "The memory-mapped index of a g-code file (see the head of this file)"
+
+    def __init__(self, data):
+        magic, version, crlf, spiral, size, mtime, digest, maxZ, slicerMaxZ, count = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or len(data) != INDEX_HEADER.size + 17 * count:
+            raise ValueError("not a g-code index (version %i)" % INDEX_VERSION)
+        self.eol = "\r\n" if crlf else "\n"
+        self.spiral = bool(spiral)
+        self.key = (size, mtime, digest)
+        self.maxZ = maxZ
+        self.slicerMaxZ = slicerMaxZ or None
+        view = memoryview(data)[INDEX_HEADER.size:]
+        self.z = view[:8 * count].cast('d')
+        self.offset = view[8 * count:16 * count].cast('Q')
+        self.hop = view[16 * count:]
+
+    def __len__(self):
+        return len(self.z)
+
+    def layers(self):
+        "Returns the (z, offset) of the Z the moves go up to, skipping the hops"
+        return [(z, offset) for z, offset, hop in zip(self.z, self.offset, self.hop) if not hop]
+
+
+def index_key(name):
+    "Returns the (size, modification time, hash) of a g-code file, that its index must match"
+    stat = os.stat(name)
+    with open(name, "rb") as f:
+        digest = zlib.crc32(f.read(INDEX_HASH_SPAN))
+        f.seek(max(INDEX_HASH_SPAN, stat.st_size - INDEX_HASH_SPAN))
+        digest = zlib.crc32(f.read(), digest)
+    return stat.st_size, stat.st_mtime_ns, digest
+
+
+def read_index(name):
+    "Returns the GcodeIndex of a g-code file, or None when there is none or when the file changed since"
+    if sys.byteorder != "little":
+        return None
+    try:
+        with open(name + ".gcidx", "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index = GcodeIndex(data)
+    except (IOError, ValueError, struct.error):
+        return None
+    return index if index.key == index_key(name) else None
+
+
+def usage(myName):
+    print("Usage:")
+    print("  " + myName + " --file gcodeFile (--layers)")
+    print("  " + myName + " -f gcodeFile (-l)")
+    sys.exit()
+
+
+if __name__ == "__main__":
+    opts, extraparams = getopt.getopt(sys.argv[1:], 'f:lh', ['file=', 'layers', 'help'])
+    filename = ""
+    perLayer = False
+    for o, p in opts:
+        if o in ['-f', '--file']:
+            filename = p
+        elif o in ['-l', '--layers']:
+            perLayer = True
+        elif o in ['-h', '--help']:
+            usage(inspect.stack()[0][1])
+    if not filename:
+        usage(inspect.stack()[0][1])
+
+    index = read_index(filename)
+    if index is None:
+        print("%s: no index, or the file changed since it was indexed (use --index with wood.py or colormix.py)"
+              % filename)
+        sys.exit(1)
+    print("%s: %i Z values, %i hops, height %gmm (slicer: %s), %s end of lines%s"
+          % (filename, len(index), sum(index.hop), index.maxZ,
+             "%gmm" % index.slicerMaxZ if index.slicerMaxZ else "unknown",
+             "\\r\\n" if index.eol == "\r\n" else "\\n", ", spiral (vase mode)" if index.spiral else ""))
+    if perLayer:
+        print("%10s %12s" % ("z", "offset"))
+        for z, offset in index.layers():
+            print("%10g %12i" % (z, offset))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# Parses a g-code file in bulk into a columnar table of moves, for analyses that would otherwise loop over lines:
+# height, layers, extrusion and print time (per layer too).
+#
+# Run it like:
+#   movetable.py --file print.gcode (--layers) (--csv table.csv)
+#
+# There is one row per G0/G1/G2/G3 move, and per command that changes how positions are read (G28, G90, G91, G92,
+# M82, M83). Columns are arrays of machine numbers: the offset of the line in the file, the command, the X, Y, Z, E
+# and F values carried forward (E is the total filament length pushed so far, whatever the extrusion mode and the
+# G92 resets), and flags telling which parameters the line had.
+#
+# Rows are found by a regular expression run on large chunks of the file, whose lookaheads capture the parameters
+# whatever their order: the parsing itself is never a Python loop over lines. Only carrying positions forward
+# walks the rows. Plain and compressed (.gz, .bz2, .xz) files are read.
+
+import sys
+import re
+import math
+import getopt
+import inspect
+import operator
+import itertools
+import gzip
+import bz2
+import lzma
+from array import array
+
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+CHUNK = 1 << 22  # bytes
+
+HAS_X = 1
+HAS_Y = 2
+HAS_Z = 4
+HAS_E = 8
+HAS_F = 16
+EXTRUDING = 32  # the move pushes filament
+RELATIVE = 64  # the values of the line were relative
+
+# G codes are kept as is, M codes get 1000 added
+COMMANDS = {}
+for letter, numbers, shift in ((b'G', (0, 1, 2, 3, 28, 90, 91, 92), 0), (b'M', (82, 83), 1000)):
+    for number in numbers:
+        for zeros in (b'', b'0', b'00'):
+            COMMANDS[letter + zeros + str(number).encode()] = shift + number
+
+# (longest first, so that G28 is not read as G2)
+MOVE_REGEX = re.compile(
+    rb'^[ \t]*(' + b'|'.join(sorted(COMMANDS, key=len, reverse=True)) + rb')(?![0-9.])'
+    + b''.join(rb'(?=(?:[^;\n]*?' + axis + rb'(-?[0-9]*\.?[0-9]+))?)' for axis in (b'X', b'Y', b'Z', b'E', b'F')),
+    re.M)
+MATCH_GROUPS = operator.methodcaller('groups', b'nan')  # missing parameters are NaN
+
+
+class MoveTable:
+    "Columns of the moves of a g-code file (see the head of this file)"
+
+    def __init__(self):
+        self.offset = array('q')
+        self.command = array('h')
+        self.x = array('d')
+        self.y = array('d')
+        self.z = array('d')
+        self.e = array('d')
+        self.f = array('d')
+        self.flags = array('B')
+        # positioning state, carried from a chunk to the next
+        self.position = [0.0, 0.0, 0.0, 0.0, 0.0]  # x, y, z, extruder position, f
+        self.extruded = 0.0
+        self.relativeXYZ = False
+        self.relativeE = False
+
+    def __len__(self):
+        return len(self.offset)
+
+    def parse(self, data, base=0, end=None):
+        "Appends the rows of a buffer that holds whole lines, base being the offset of the buffer in the file"
+        matches = list(MOVE_REGEX.finditer(data, 0, len(data) if end is None else end))
+        if not matches:
+            return
+        self.offset.extend(map(base.__add__, map(operator.methodcaller('start'), matches)))
+        commands, xs, ys, zs, es, fs = zip(*map(MATCH_GROUPS, matches))
+        commands = array('h', map(COMMANDS.__getitem__, commands))
+        self.command.extend(commands)
+        self.carry_forward(commands, *[array('d', map(float, column)) for column in (xs, ys, zs, es, fs)])
+
+    def carry_forward(self, commands, xs, ys, zs, es, fs):
+        "Appends the positions of new rows, given their raw values (NaN when missing)"
+        x, y, z, e, f = self.position
+        extruded = self.extruded
+        relativeXYZ = self.relativeXYZ
+        relativeE = self.relativeE
+        outX, outY, outZ, outE, outF, outFlags = array('d'), array('d'), array('d'), array('d'), array('d'), array('B')
+        for command, x1, y1, z1, e1, f1 in zip(commands, xs, ys, zs, es, fs):
+            flags = (HAS_X if x1 == x1 else 0) | (HAS_Y if y1 == y1 else 0) | (HAS_Z if z1 == z1 else 0)\
+                | (HAS_E if e1 == e1 else 0) | (HAS_F if f1 == f1 else 0)
+            if command <= 3:
+                if relativeXYZ:
+                    flags |= RELATIVE
+                    x += x1 if x1 == x1 else 0
+                    y += y1 if y1 == y1 else 0
+                    z += z1 if z1 == z1 else 0
+                else:
+                    x = x1 if x1 == x1 else x
+                    y = y1 if y1 == y1 else y
+                    z = z1 if z1 == z1 else z
+                if e1 == e1:
+                    if relativeE:
+                        flags |= RELATIVE
+                    delta = e1 if relativeE else e1 - e
+                    e += delta
+                    extruded += delta
+                    if delta > 0:
+                        flags |= EXTRUDING
+                f = f1 if f1 == f1 else f
+            elif command == 28:  # homing: the given axes, or all of them
+                if not flags & (HAS_X | HAS_Y | HAS_Z):
+                    x = y = z = 0.0
+                x = 0.0 if flags & HAS_X else x
+                y = 0.0 if flags & HAS_Y else y
+                z = 0.0 if flags & HAS_Z else z
+            elif command == 90:
+                relativeXYZ = relativeE = False
+            elif command == 91:
+                relativeXYZ = relativeE = True
+            elif command == 92:  # position reset (only the extruder one matters to the filament length)
+                x = x1 if x1 == x1 else x
+                y = y1 if y1 == y1 else y
+                z = z1 if z1 == z1 else z
+                e = e1 if e1 == e1 else e
+            elif command == 1082:
+                relativeE = False
+            elif command == 1083:
+                relativeE = True
+            outX.append(x)
+            outY.append(y)
+            outZ.append(z)
+            outE.append(extruded)
+            outF.append(f)
+            outFlags.append(flags)
+        self.x.extend(outX)
+        self.y.extend(outY)
+        self.z.extend(outZ)
+        self.e.extend(outE)
+        self.f.extend(outF)
+        self.flags.extend(outFlags)
+        self.position = [x, y, z, e, f]
+        self.extruded = extruded
+        self.relativeXYZ = relativeXYZ
+        self.relativeE = relativeE
+
+    def durations(self):
+        "Returns the estimated duration of each row (distance over feed rate, without accelerations)"
+        out = array('d', [0.0])
+        for i in range(1, len(self.offset)):
+            if self.command[i] > 3 or not self.f[i]:
+                out.append(0.0)
+                continue
+            distance = math.sqrt((self.x[i] - self.x[i - 1]) ** 2 + (self.y[i] - self.y[i - 1]) ** 2
+                                 + (self.z[i] - self.z[i - 1]) ** 2) or abs(self.e[i] - self.e[i - 1])
+            out.append(60.0 * distance / self.f[i])
+        return out
+
+    def layers(self):
+        "Returns the (z, first row, end row) of the layers: Z of the extruding moves, in the order they are printed"
+        layers = []
+        z = None
+        for i in itertools.compress(range(len(self.flags)), map(EXTRUDING.__and__, self.flags)):
+            if self.z[i] != z:
+                z = self.z[i]
+                if layers:
+                    layers[-1][2] = i
+                layers.append([z, i, len(self.flags)])
+        return [tuple(layer) for layer in layers]
+
+
+def open_gcode(name):
+    "Opens a plain or compressed g-code file as a binary stream"
+    with open(name, "rb") as f:
+        head = f.read(6)
+    for magic, opener in ((b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open)):
+        if head.startswith(magic):
+            return opener(name, "rb")
+    return open(name, "rb")
+
+
+def move_table(name):
+    "Returns the MoveTable of a g-code file, read by large chunks"
+    table = MoveTable()
+    base = 0
+    rest = b""
+    with open_gcode(name) as f:
+        while True:
+            data = f.read(CHUNK)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            table.parse(data, base, cut)
+            base += cut
+            rest = data[cut:]
+    table.parse(rest, base)
+    return table
+
+
+def usage(myName):
+    print("Usage:")
+    print("  " + myName + " --file gcodeFile (--layers) (--csv csvFile)")
+    print("  " + myName + " -f gcodeFile (-l) (-c csvFile)")
+    sys.exit()
+
+
+if __name__ == "__main__":
+    opts, extraparams = getopt.getopt(sys.argv[1:], 'f:lc:h', ['file=', 'layers', 'csv=', 'help'])
+    filename = ""
+    perLayer = False
+    csvFilename = ""
+    for o, p in opts:
+        if o in ['-f', '--file']:
+            filename = p
+        elif o in ['-l', '--layers']:
+            perLayer = True
+        elif o in ['-c', '--csv']:
+            csvFilename = p
+        elif o in ['-h', '--help']:
+            usage(inspect.stack()[0][1])
+    if not filename:
+        usage(inspect.stack()[0][1])
+
+    table = move_table(filename)
+    durations = table.durations()
+    layers = table.layers()
+    print("%s: %i rows, height %gmm, %i layers, %.1fmm of filament, about %.0f minutes"
+          % (filename, len(table), max(table.z) if len(table) else 0, len(layers),
+             table.e[-1] if len(table) else 0, sum(durations) / 60))
+    if perLayer:
+        print("%10s %8s %10s %9s" % ("z", "rows", "filament", "seconds"))
+        for z, start, end in layers:
+            print("%10g %8i %10.2f %9.1f" % (z, end - start, table.e[end - 1] - table.e[start - 1 if start else 0],
+                                             sum(durations[start:end])))
+    if csvFilename:
+        with open(csvFilename, "w") as f:
+            f.write("offset,command,x,y,z,e,f,flags\n")
+            for row in zip(table.offset, table.command, table.x, table.y, table.z, table.e, table.f, table.flags):
+                f.write("%i,%i,%g,%g,%g,%g,%g,%i\n" % row)
@@ -0,0 +1,29 @@
+; Moves mixed with commands whose numbers look like the ones of moves, but that the move table must skip
+M92 X80 Y80 Z400 E93 ; steps per mm
+M3 S1000 ; spindle on
+M0 ; pause
+M1
+M2
+M28 E1.gcode
+M90
+M91
+G82 X1 Y1 Z-1
+G83 X1 Y1 Z-1
+G28
+G90
+M82
+G92 E0
+G1 Z0.2 F3000
+G1 X10 Y10 E1
+G0 X20 Y10
+G1 X20 Y20 E2
+M83
+G1 X10 Y20 E1
+G91
+G1 Z0.2
+G1 X-10 E1
+G90
+M83
+G2 X10 Y10 I5 J5 E1
+G3 X0 Y0 I-5 J-5 E1
+M5 ; spindle off
@@ -0,0 +1,13 @@
+#!/bin/bash
+# Runs movetable.py on a file where moves are mixed with commands that only look like them (M92, M3, M28, G82...):
+# there must be a row for each move and positioning command, and none for the others.
+set -e
+
+table=$(mktemp)
+trap 'rm -f "$table"' EXIT
+
+python ../movetable.py --file marlin_commands.gcode --layers --csv "$table"
+rows=$(($(wc -l < "$table") - 1))
+expected=$(grep -cE '^(G0*[0-3]|G28|G9[0-2]|M8[23])( |$)' marlin_commands.gcode)
+echo "$rows rows, $expected expected"
+[[ $rows -eq $expected ]]
@@ -6,13 +6,31 @@
 #Param: toolCount(float:0) Or the number of switchable tools (0=off, up to 15)
 #Param: mixSpeed(float:1.0) Rate of change (the bigger the faster)
 #Param: randomSeed(float:2) Start value of the pseudo-random, repeatable texture.
+#Param: mixResolution(float:1) Smallest mixing change worth a new M163/M164 set (percent)
+#Param: maxChangeRate(float:0) Maximum mixing or tool changes per mm of Z (0=unlimited)
+#Param: pathSpeed(float:0) Rate of change of the mix along the extrusion path, relative to Z (0=off)
+#Param: minSegment(float:1.0) Shortest piece extruding moves are split into for path gradients (mm)
+#Param: spiralGrid(float:0) Z step of changes in spiral (vase mode) prints, 0 to detect them, negative to disable (mm)
 
 import inspect
 import sys
+import os
 import getopt
 import re
 import math
 import random
+import multiprocessing
+import gzip
+import bz2
+import lzma
+import struct
+import zlib
+import mmap
+import threading
+import io
+import queue
+import json
+import time
 
 __author__ = 'Jeremie Francois (jeremie.francois@gmail.com)'
 __date__ = '$Date: 2016/05/24 18:24:13 $'
@@ -31,6 +49,47 @@ __license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agp
 #
 # Use --random followed by an integer to change the shape of the generated random pattern
 #
+# Compressed files (.gz, .bz2, .xz) and binary g-code (.bgcode) are processed as is. Use --output to write
+# elsewhere than in place, and --compress (gz, bz2, xz, bgcode or none) with --compress-level to choose the
+# output compression
+#
+# Use --jobs to process a big file with several processes (the output is the same)
+#
+# Use --live to write the g-code to the standard output as it is being made, e.g. for a print server to send the
+# first lines to the printer at once.
+#
+# The file is quickly scanned for its total height. With --normalize header, that height is read from the slicer
+# comments (or the graph of a former wood run) at the top or the end of the file instead, when the last moves of the
+# file confirm it and no move of the start goes higher (else the file is scanned)
+#
+# Use --path-speed to also vary the mix along the extrusion path within each layer (1.0 changes colors as fast
+# per mm of path as per mm of Z). Extruding moves are then split, in pieces not shorter than --min-segment mm.
+# It needs --mix, and does not go with --max-rate (changes along the path are not spaced).
+#
+# Use --stats to write the statistics of the weights (or tools) and the Z-to-mix curve to a small CSV (or JSON,
+# after the extension) file, gathered while processing. --doc writes it beside the output, as outputFile.mix.csv
+#
+# Use --resolution to only change the mix when a weight moves by that many percents, and
+# --max-rate to cap the number of mixing or tool changes per mm of Z (each change may cost a purge)
+#
+# Use --index to keep what is found about the source file (the Z of the moves, the end of lines and the slicer
+# settings) in a sidecar file, so that running again on the same source (with --output) skips these passes.
+#
+# Use --checksum to write each command with a line number and a checksum (N123 G1 X2*45), the way hosts send them
+# over serial lines, so that they can pass the lines through as they are. --strip-comments removes the comments.
+#
+# Use --follow to process the file while the slicer is still writing it (like `tail -f`), with --output or --live:
+# it is complete once it has not grown for --follow-idle seconds (5 by default). Switching tools needs the height of
+# the print from the slicer header, else the end of the file is waited for. The height in the header comment is
+# written at the end (with a plain --output file), or taken from the slicer header.
+#
+# Spiral (vase mode) prints, where Z rises a little with every move, are detected from the slicer settings: the mix
+# is then planned once per 0.1mm step of Z, not for every move. Use --spiral-grid to choose that step (or a negative
+# value to handle the file as any other).
+#
+# The g-code is handled as bytes: lines that are not changed are never decoded, and the end of lines of the file
+# (\n or \r\n) is kept.
+#
 # Latest version: 20151001-191033
 #
 
@@ -39,27 +98,62 @@ def plugin_standalone_usage(my_name):
     print("Usage:")
     print("  "+my_name+" --file stringGcodeFile --extruders integerToolCount --random 123 ")
     print("  "+my_name+" --file stringGcodeFile --mix integerNozzleCount --speed integerPercentage --random 123 )")
+    print("  (--resolution percentStep) (--max-rate changesPerMm | --path-speed ratio (--min-segment mm))")
+    print("  (--live (--normalize scan|header)) (--stats statsFile.csv|statsFile.json) (--doc) (--spiral-grid mm)")
+    print("  (--index) (--checksum) (--strip-comments) (--follow (--follow-idle seconds))")
+    print("  (--output outputFile) (--compress gz|bz2|xz|bgcode|none) (--compress-level integer) (--jobs processCount)")
     print("Licensed under CC-BY 2012-2015 by jeremie.francois@gmail.com (www.tridimake.com)")
     sys.exit()
 try:
     # this variable is defined only when we are being called within Cura
     filename
-    insertPlotData=1  # debug for gnuplot
+    statsFilename = ""
+    writeStatsBeside = False
+    outputFilename = ""
+    outputCodec = ""
+    outputLevel = None
+    jobs = 1
+    live = False
+    normalization = "scan"
+    useIndex = False
+    checksumLines = False
+    stripComments = False
+    following = False
+    followIdle = 5.0
 except NameError:
     # Then, we are called from the command line (not from Cura)
     # trying len(inspect.stack()) > 2 would be less secure btw
     opts, extra_params = getopt.getopt(
         sys.argv[1:],
-        'x:m:s:r:f:hd',
-        ['extruders=', 'mix=', 'speed=', 'random=', 'file=', 'help', 'doc'])
+        'x:m:s:r:f:q:l:o:j:y:g:vn:t:hd',
+        ['extruders=', 'mix=', 'speed=', 'random=', 'file=', 'resolution=', 'max-rate=', 'path-speed=', 'min-segment=',
+         'output=', 'compress=', 'compress-level=', 'jobs=', 'live', 'normalize=', 'stats=', 'help', 'doc',
+         'spiral-grid=', 'index', 'checksum', 'strip-comments', 'follow', 'follow-idle='])
 
     filename = ""
+    outputFilename = ""
+    outputCodec = ""
+    outputLevel = None
+    jobs = 1
+    live = False
+    normalization = "scan"
 
     toolCount = 0
     mixCount = 3
     mixSpeed = 1.0
     randomSeed = 2
-    insertPlotData = 0
+    mixResolution = 1
+    maxChangeRate = 0
+    pathSpeed = 0
+    minSegment = 1.0
+    statsFilename = ""
+    writeStatsBeside = False
+    spiralGrid = 0
+    useIndex = False
+    checksumLines = False
+    stripComments = False
+    following = False
+    followIdle = 5.0
 
     for o, p in opts:
         if o in ['-f', '--file']:
@@ -72,8 +166,42 @@ except NameError:
             mixSpeed = float(p)/100
         elif o in ['-r', '--random']:
             toolCount = int(p)
+        elif o in ['-q', '--resolution']:
+            mixResolution = float(p)
+        elif o in ['-l', '--max-rate']:
+            maxChangeRate = float(p)
+        elif o in ['-y', '--path-speed']:
+            pathSpeed = float(p)
+        elif o in ['-g', '--min-segment']:
+            minSegment = float(p)
+        elif o in ['-o', '--output']:
+            outputFilename = p
+        elif o == '--compress':
+            outputCodec = p
+        elif o == '--compress-level':
+            outputLevel = int(p)
+        elif o in ['-j', '--jobs']:
+            jobs = int(p)
+        elif o in ['-v', '--live']:
+            live = True
+        elif o in ['-n', '--normalize']:
+            normalization = p
+        elif o in ['-t', '--stats']:
+            statsFilename = p
         elif o in ['-d', '--doc']:
-            insertPlotData = 1
+            writeStatsBeside = True
+        elif o == '--spiral-grid':
+            spiralGrid = float(p)
+        elif o == '--index':
+            useIndex = True
+        elif o == '--checksum':
+            checksumLines = True
+        elif o == '--strip-comments':
+            stripComments = True
+        elif o == '--follow':
+            following = True
+        elif o == '--follow-idle':
+            followIdle = float(p)
     if not filename:
         plugin_standalone_usage(inspect.stack()[0][1])
 
@@ -81,11 +209,13 @@ except NameError:
 # ########### END CURA PLUGIN STAND-ALONIFICATION ############
 
 
+numberRegex = re.compile(rb'[0-9]+\.?[0-9]*')
+
+
 def get_value(line, key, default=None):
-    if (key not in line) or (';' in line and line.find(key) > line.find(';')):
+    if (key not in line) or (b';' in line and line.find(key) > line.find(b';')):
         return default
-    sub_part = line[line.find(key) + 1:]
-    m = re.search('^[0-9]+\.?[0-9]*', sub_part)
+    m = numberRegex.match(line, line.find(key) + 1)
     if m is None:
         return default
     try:
@@ -93,21 +223,779 @@ def get_value(line, key, default=None):
     except ValueError:
         return default
 
+
+# G0 and G1 "move" commands, with the G value in group 1 and the Z (if any) in group 2: i.e. get_value(line, b'G')
+# and get_value(line, b'Z') of the moves, in one go
+moveLineRegex = re.compile(rb'[^G;\n]*G0*([01])(?:\.0*)?(?![0-9.])(?:[^Z;\n]*Z([0-9]+\.?[0-9]*))?')
+
+# Binary g-code (.bgcode) is a file header followed by blocks, each made of a header, parameters, data and a CRC32.
+# Only the g-code blocks are unpacked, metadata and thumbnail blocks are passed through to the output.
+BGCODE_GCODE_BLOCK = 1
+BGCODE_THUMBNAIL_BLOCK = 5
+BGCODE_MAX_BLOCK_SIZE = 65535
+MEATPACK_CHARS = "0123456789. \nGX"  # 4-bit codes, 0b1111 announces a full character
+MEATPACK_G_PARAMETERS = "XYZEFIJRPWHCA"  # spaces stripped by MeatPack are put back before those
+
+
+def heatshrink_decode(data, window_bits, lookahead_bits):
+    "Unpacks heatshrink (LZSS) data: a 1 bit announces a literal byte, a 0 bit a back reference"
+    out = bytearray()
+    state = [0, 0, 0]  # bit accumulator, bits in the accumulator, next byte index
+
+    def take(count):
+        acc, n, pos = state
+        while n < count:
+            if pos >= len(data):
+                return None
+            acc = (acc << 8) | data[pos]
+            pos += 1
+            n += 8
+        n -= count
+        state[0], state[1], state[2] = acc & ((1 << n) - 1), n, pos
+        return acc >> n
+
+    while True:
+        tag = take(1)
+        if tag is None:
+            break
+        if tag:
+            c = take(8)
+            if c is None:
+                break
+            out.append(c)
+        else:
+            index = take(window_bits)
+            count = take(lookahead_bits)
+            if index is None or count is None:
+                break  # padding of the last byte
+            start = len(out) - index - 1
+            count += 1
+            if index + 1 >= count:
+                out += out[start:start + count]
+            else:
+                for i in range(count):
+                    out.append(out[start + i])
+    return bytes(out)
+
+
+def meatpack_decode(data):
+    "Unpacks MeatPack data, where the most common g-code characters are packed by pairs in a byte"
+    out = []
+    packing = False
+    noSpaces = False
+    lineIsMove = False
+    inComment = False
+
+    def put(c):
+        nonlocal lineIsMove, inComment
+        if c == "\n":
+            lineIsMove = inComment = False
+        elif c == ";":
+            inComment = True
+        elif not inComment:
+            if out and out[-1] == "\n" or not out:
+                lineIsMove = (c == "G")
+            elif noSpaces and lineIsMove and c in MEATPACK_G_PARAMETERS and out[-1] != " ":
+                out.append(" ")
+        out.append(c)
+
+    i = 0
+    while i < len(data):
+        b = data[i]
+        if b == 0xFF and i + 2 < len(data) and data[i + 1] == 0xFF:  # signal
+            signal = data[i + 2]
+            i += 3
+            if signal == 251:
+                packing = True
+            elif signal == 250:
+                packing = False
+            elif signal == 247:
+                noSpaces = True
+            elif signal == 246:
+                noSpaces = False
+            elif signal == 249:
+                packing = noSpaces = False
+            continue
+        i += 1
+        if not packing:
+            put(chr(b))
+            continue
+        for nibble in (b & 0xF, b >> 4):
+            if nibble == 0xF:
+                put(chr(data[i]))
+                i += 1
+            elif nibble == 11 and noSpaces:
+                put("E")
+            else:
+                put(MEATPACK_CHARS[nibble])
+    return "".join(out).encode("latin_1")  # (characters were made from bytes)
+
+
+def bgcode_blocks(f):
+    "Yields the (type, compression, uncompressed size, parameters, data) blocks of an opened binary g-code file"
+    magic, version, checksumType = struct.unpack('<4sIH', f.read(10))
+    if magic != b'GCDE':
+        raise ValueError("not a binary g-code file")
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        blockType, compression, size = struct.unpack('<HHI', head)
+        if compression:
+            head += f.read(4)
+            dataSize = struct.unpack('<I', head[8:])[0]
+        else:
+            dataSize = size
+        params = f.read(6 if blockType == BGCODE_THUMBNAIL_BLOCK else 2)
+        data = f.read(dataSize)
+        if checksumType == 1:
+            crc = struct.unpack('<I', f.read(4))[0]
+            if zlib.crc32(head + params + data) & 0xFFFFFFFF != crc:
+                raise ValueError("corrupted binary g-code block (bad CRC)")
+        yield blockType, compression, size, params, data
+
+
+def bgcode_unpack(compression, params, data):
+    "Returns the plain content of a block"
+    if compression == 1:
+        data = zlib.decompress(data)
+    elif compression in (2, 3):
+        data = heatshrink_decode(data, 11 if compression == 2 else 12, 4)
+    if struct.unpack('<H', params[:2])[0]:  # g-code encoded with MeatPack (with or without comments)
+        data = meatpack_decode(data)
+    return data
+
+
+class BinaryGcode:
+    "Reads (as lines) or writes the g-code of a binary g-code file, like a binary file object"
+
+    def __init__(self, name, mode="r", compresslevel=None, source=None):
+        self.writing = 'w' in mode
+        self.level = -1 if compresslevel is None else int(compresslevel)
+        self.pending = []
+        self.pendingSize = 0
+        self.blocks = None
+        self.file = open(name, "wb" if self.writing else "rb")
+        if self.writing:
+            self.file.write(struct.pack('<4sIH', b'GCDE', 1, 1))
+            if source and detect_codec(source) == 'bgcode':
+                with open(source, "rb") as f:
+                    for blockType, compression, size, params, data in bgcode_blocks(f):
+                        if blockType == BGCODE_GCODE_BLOCK:
+                            continue
+                        if not compression and blockType != BGCODE_THUMBNAIL_BLOCK:
+                            compression, data = 1, zlib.compress(data, self.level)
+                        self.write_block(blockType, compression, size, params, data)
+            else:
+                for blockType in (3, 4, 2):  # printer, print and slicer metadata are expected before the g-code
+                    self.write_block(blockType, 0, 0, struct.pack('<H', 0), b'')
+
+    def write_block(self, blockType, compression, size, params, data):
+        head = struct.pack('<HHI', blockType, compression, size)
+        if compression:
+            head += struct.pack('<I', len(data))
+        self.file.write(head + params + data)
+        self.file.write(struct.pack('<I', zlib.crc32(head + params + data) & 0xFFFFFFFF))
+
+    def read(self, size=-1):
+        "Returns the g-code of the next g-code block (whatever the size), or empty bytes at the end"
+        if self.blocks is None:
+            self.blocks = bgcode_blocks(self.file)
+        for blockType, compression, blockSize, params, data in self.blocks:
+            if blockType == BGCODE_GCODE_BLOCK:
+                return bgcode_unpack(compression, params, data)
+        return b""
+
+    def __iter__(self):
+        rest = b""
+        while True:
+            data = self.read()
+            if not data:
+                break
+            lines = io.BytesIO(rest + data).readlines()
+            rest = lines.pop() if not lines[-1].endswith(b"\n") else b""
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.pendingSize >= BGCODE_MAX_BLOCK_SIZE:
+            self.flush_blocks(False)
+
+    def flush_blocks(self, final):
+        data = b"".join(self.pending)
+        while len(data) >= BGCODE_MAX_BLOCK_SIZE or (final and data):
+            cut = data.rfind(b"\n", 0, BGCODE_MAX_BLOCK_SIZE) + 1 or BGCODE_MAX_BLOCK_SIZE
+            if len(data) <= BGCODE_MAX_BLOCK_SIZE and final:
+                cut = len(data)
+            block = data[:cut]
+            self.write_block(BGCODE_GCODE_BLOCK, 1, len(block), struct.pack('<H', 0), zlib.compress(block, self.level))
+            data = data[cut:]
+        self.pending = [data]
+        self.pendingSize = len(data)
+
+    def close(self):
+        if self.writing:
+            self.flush_blocks(True)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Compressed g-code files: (codec name, magic bytes, file extension, opener)
+gcodeCodecs = [('gz', b'\x1f\x8b', '.gz', gzip.open),
+               ('bz2', b'BZh', '.bz2', bz2.open),
+               ('xz', b'\xfd7zXZ\x00', '.xz', lzma.open),
+               ('bgcode', b'GCDE', '.bgcode', BinaryGcode)]
+
+
+def detect_codec(name):
+    "Returns the compression codec of a g-code file from its magic bytes (or extension when empty), None if plain"
+    head = b''
+    if os.path.isfile(name):
+        with open(name, "rb") as f:
+            head = f.read(6)
+    for codec, magic, ext, opener in gcodeCodecs:
+        if head.startswith(magic) or (not head and name.lower().endswith(ext)):
+            return codec
+    return None
+
+
+def open_gcode(name, mode="r", codec=None, level=None, source=None):
+    """
+    Opens a plain, compressed or binary g-code file as a binary stream (g-code is handled as bytes, so that nothing
+    is decoded nor changed behind our back), compressed files are streamed (never fully in memory). When writing
+    binary g-code, the metadata blocks of the source file are kept.
+    """
+    if codec == 'bgcode':
+        return BinaryGcode(name, mode, level, source)
+    for c, magic, ext, opener in gcodeCodecs:
+        if c == codec:
+            if 'w' in mode and level is not None:
+                if c == 'xz':
+                    return opener(name, mode + "b", preset=int(level))
+                return opener(name, mode + "b", compresslevel=int(level))
+            return opener(name, mode + "b")
+    return open(name, mode + "b")
+
+
 mixCount = int(mixCount)
 toolCount = int(toolCount)
+mixResolution = max(1, float(mixResolution))
+maxChangeRate = float(maxChangeRate)
+pathSpeed = float(pathSpeed)
+minSegment = max(0.01, float(minSegment))
+if pathSpeed and (mixCount == 0 or maxChangeRate > 0):
+    sys.stderr.write("--path-speed only works with mixes (not tools), and without --max-rate\n")
+    sys.exit(1)
 
 random.seed(randomSeed)
 
-with open(filename, "r") as f:
-    lines = f.readlines()
+# I/O pipeline: a thread reads the source by large chunks while lines are processed, and another one writes the
+# output by large chunks. The queues are bounded, so that a slow side holds the other back.
+PIPELINE_CHUNK = 1 << 20  # bytes
+PIPELINE_DEPTH = 8  # chunks
+
+
+def pipelined_chunks(f):
+    "Yields the lines of an opened file by lists (one per chunk), read ahead by a thread"
+    chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            rest = b""
+            while not stop.is_set():
+                data = f.read(PIPELINE_CHUNK)
+                if not data:
+                    break
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                rest = data[cut:]
+                if cut:
+                    put(io.BytesIO(data[:cut]).readlines())  # lines keep their own end (\n or \r\n)
+            if rest:
+                put([rest])
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+class PipelinedWriter:
+    "Gathers what is written in large chunks, that a thread writes to the underlying file while processing goes on"
+
+    def __init__(self, f):
+        self.file = f
+        self.buffer = []
+        self.size = 0
+        self.error = None
+        self.chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writer(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.file.write(data)
+                except Exception as e:
+                    self.error = e  # reported on close
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= PIPELINE_CHUNK:
+            self.chunks.put(b"".join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        if self.buffer:
+            self.chunks.put(b"".join(self.buffer))
+            self.buffer = []
+        self.chunks.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#
+# Follow mode (--follow): the source is read as the slicer writes it, and taken as complete once it has not grown for
+# followIdle seconds. The height of the print comes from the slicer header, or is fixed up in the output at the end.
+#
+FOLLOW_POLL = 0.2  # seconds
+FOLLOW_HEAD = 65536  # bytes, as read by the analysis of the head of the file
+
+
+def wait_for_source(size):
+    "Waits until the source holds that many bytes, or has not grown for followIdle seconds"
+    lastSize = None
+    idleSince = time.time()
+    while True:
+        current = os.path.getsize(filename) if os.path.isfile(filename) else -1
+        if current >= size:
+            return
+        if current != lastSize:
+            lastSize = current
+            idleSince = time.time()
+        elif current >= 0 and time.time() - idleSince >= followIdle:
+            return
+        time.sleep(FOLLOW_POLL)
+
+
+def followed_lines():
+    "Streams the lines of the source as it grows, until it has not grown for followIdle seconds (keeps its height)"
+    global followedMaxZ
+    with open(filename, "rb") as f:
+        rest = b""
+        idleSince = time.time()
+        while True:
+            data = f.read(PIPELINE_CHUNK)
+            if data:
+                idleSince = time.time()
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                rest = data[cut:]
+                followedMaxZ = max([followedMaxZ] + [float(z) for z in moveZRegex.findall(data, 0, cut)])
+                for line in io.BytesIO(data[:cut]).readlines():
+                    yield line
+            elif time.time() - idleSince < followIdle:
+                time.sleep(FOLLOW_POLL)
+            else:
+                break
+        if rest:
+            followedMaxZ = max([followedMaxZ] + [float(z) for z in moveZRegex.findall(rest)])
+            yield rest
+
+
+if following:
+    wait_for_source(FOLLOW_HEAD)
+inputCodec = detect_codec(filename)
+if following and (inputCodec is not None or not (outputFilename or live)):
+    sys.stderr.write("Following needs a plain source, and --output or --live\n")
+    sys.exit(1)
+if not outputFilename:
+    outputFilename = filename  # patch in place
+if not outputCodec:
+    outputCodec = inputCodec if outputFilename == filename else detect_codec(outputFilename)
+if writeStatsBeside and not statsFilename:
+    statsFilename = outputFilename + ".mix.csv"
+# (a plain output file can be fixed up at the end, when the source is followed)
+fixingUp = following and not live and outputCodec is None and not (checksumLines or stripComments)
+if following:
+    jobs = 1
+    useIndex = False
+
+# lines to remove from the source code
+regexToRemove = rb'^\s*(;mixing|'
+if toolCount > 0:
+    regexToRemove += rb't[0-9]*\r?$'
+else:
+    regexToRemove += rb'm163|m164'
+regexToRemove += rb')'
+
+lines = None  # only loaded in memory by the parallel mode
+
+
+def gcode_lines():
+    "Streams the lines of the source g-code file"
+    if lines is not None:
+        for line in lines:
+            yield line
+        return
+    if following:
+        for line in followed_lines():
+            yield line
+        return
+    with open_gcode(filename, "r", inputCodec) as f:
+        chunks = pipelined_chunks(f)
+        try:
+            for chunk in chunks:
+                for line in chunk:
+                    yield line
+        finally:
+            chunks.close()
+
+
+#
+# Parallel mode: the file is split in shards at layer changes, that a pool of processes tokenizes and then rebuilds.
+# Only the sequential state (current Z and mixing step) is replayed serially. The output is the same.
+#
+def shard_bounds(count):
+    "Returns the (start, end) line indexes of about count shards, each starting at a move along Z"
+    bounds = []
+    start = 0
+    step = max(1, len(lines) // count)
+    index = step
+    while index < len(lines):
+        if get_value(lines[index], b'Z', None) is None or get_value(lines[index], b'G', None) not in (0, 1):
+            index += 1
+            continue
+        bounds.append((start, index))
+        start = index
+        index += step
+    bounds.append((start, len(lines)))
+    return bounds
+
+
+def scan_shard(bounds):
+    """
+    Worker: returns the (index, kind, z) events of a shard, kind being 'g' for the moves along Z (and the first
+    move of the shard) and 'r' for the lines to remove
+    """
+    start, end = bounds
+    events = []
+    firstMove = True
+    for index in range(start, end):
+        line = lines[index]
+        move = moveLineRegex.match(line)
+        if move:
+            z = float(move.group(2)) if move.group(2) else None
+            if z is not None or firstMove:
+                events.append((index, 'g', z))
+                firstMove = False
+        elif re.search(regexToRemove, line, re.IGNORECASE):
+            events.append((index, 'r', None))
+    return events
+
+
+def render_shard(job):
+    "Worker: rebuilds the output of a shard, given the lines to drop and the commands to insert before lines"
+    start, end, before, dropped = job
+    out = []
+    for index in sorted(set(before) | dropped):
+        out.extend(lines[start:index])
+        if index in before:
+            out.append(before[index])
+        if index not in dropped:
+            out.append(lines[index])
+        start = index + 1
+    out.extend(lines[start:end])
+    return b"".join(out)
+
+
+events = None
+if jobs > 1 and not pathSpeed and not live and "fork" in multiprocessing.get_all_start_methods():
+    lines = list(gcode_lines())
+    pool = multiprocessing.get_context("fork").Pool(jobs)  # workers share the lines loaded above
+    shards = shard_bounds(jobs * 4)
+    events = []
+    for shardEvents in pool.map(scan_shard, shards):
+        events.extend(shardEvents)
+
+
+# Same as the Z of the moves found line by line, but run by the regular expression engine on large chunks
+moveZRegex = re.compile(rb'^[^G;\n]*G0*[01](?:\.0*)?(?![0-9.])[^Z;\n]*Z([0-9]+\.?[0-9]*)', re.M)
+
+
+def scan_z():
+    "Yields the Z of each move along Z of the source file, as get_z() would, but by large chunks"
+    rest = b""
+    with open_gcode(filename, "r", inputCodec) as f:
+        while True:
+            data = f.read(PIPELINE_CHUNK)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            rest = data[cut:]
+            for z in moveZRegex.findall(data, 0, cut):
+                yield float(z)
+    for z in moveZRegex.findall(rest):
+        yield float(z)
+
+
+TAIL_SIZE = 1 << 18  # bytes
+
 
-# Find the total height of the object
+sourceEnds = None  # (head, tail) of the source, once read
+
+
+def gcode_ends():
+    """
+    Returns the head and the tail of the source g-code, read once for all the analyses below: plain seekable files
+    are seeked, others are unpacked through (once).
+    """
+    global sourceEnds
+    if sourceEnds is None:
+        with open_gcode(filename, "r", inputCodec) as f:
+            head = f.read(65536)
+            if inputCodec is None and f.seekable():
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - TAIL_SIZE))
+                tail = f.read()
+            else:
+                tail = head[-TAIL_SIZE:]
+                while True:
+                    data = f.read(PIPELINE_CHUNK)
+                    if not data:
+                        break
+                    tail = (tail + data)[-TAIL_SIZE:]
+        sourceEnds = head, tail
+    return sourceEnds
+
+
+def slicer_max_z(head, tail):
+    """
+    Returns the height of the print as announced in the head or the tail of the file (by the slicer, or by the graph
+    of a former run), when the highest move in the tail of the file confirms it and no move of the head (e.g. a lift
+    of the start script) goes higher. Else None, and the file must be scanned.
+    """
+    tail = tail[tail.find(b"\n") + 1:]  # (the first line may be cut)
+    tailZ = [float(z) for z in moveZRegex.findall(tail)]
+    headZ = [float(z) for z in moveZRegex.findall(head[:head.rfind(b"\n") + 1])]  # (the last line may be cut)
+    if not tailZ or max(headZ, default=0) > max(tailZ) + 0.0005:
+        return None
+    for z in slicer_heights(head, tail):
+        if abs(z - max(tailZ)) < 0.0005:
+            return max(tailZ)  # as scanned
+    return None
+
+
+def slicer_heights(head, tail):
+    "Returns the heights of the print announced in the head and the tail of the file, head first"
+    candidates = []
+    for text in (head, tail):
+        candidates += re.findall(rb'^;MAXZ:\s*([0-9.]+)', text, re.M)  # Cura
+        candidates += re.findall(rb'^;\s*max_layer_z\s*=\s*([0-9.]+)', text, re.M)  # PrusaSlicer
+    candidates += re.findall(rb'^;WoodGraph: Z ([0-9.]+)', tail, re.M)[-1:]  # former run, last layer
+    count = re.search(rb'^;\s*Layer[ _]count:\s*([0-9]+)', head, re.M | re.I)
+    height = re.search(rb'Layer height:\s*([0-9.]+)', head, re.I)
+    if count and height:
+        candidates.append(int(count.group(1)) * float(height.group(1)))
+    return [float(z) for z in candidates]
+
+
+SPIRAL_SETTINGS = rb'magic_spiralize = True|^;\s*spiral_vase\s*=\s*1|^;\s*spiralVaseMode,1'  # Cura, Prusa, S3D
+
+
+def spiral_vase(head, tail):
+    "Tells whether the slicer settings, at the top or the end of the file, enable the spiral (vase) mode"
+    return re.search(SPIRAL_SETTINGS, head + b"\n" + tail, re.M) is not None
+
+
+def detect_eol():
+    "Returns the end of line of the first line of the source file, so that the lines we add are consistent with it"
+    with open_gcode(filename, "r", inputCodec) as f:
+        head = f.read(65536)
+    return "\r\n" if head[:head.find(b"\n") + 1].endswith(b"\r\n") else "\n"
+
+
+#
+# With --index, what the passes above find is kept in a binary sidecar file (gcodeFile.gcidx) that later runs on the
+# same source memory-map instead of analysing it again. An index is only valid for the size, modification time and
+# hash (of the head and the tail) of the source it was made from, and it is removed when a file is written over it
+# (e.g. the source patched in place). See analysis/gcodeindex.py for its layout.
+#
+INDEX_MAGIC = b'GCIX'
+INDEX_VERSION = 1
+# magic, version, crlf, spiral, size, mtime (ns), hash, maxZ, slicer maxZ (0 if unknown), count of Z
+INDEX_HEADER = struct.Struct('<4sHBBQqIddI')
+INDEX_HASH_SPAN = 1 << 20  # bytes hashed at each end of the source
+
+
+def index_key():
+    "Returns the (size, modification time, hash) of the source file, that its index must match"
+    stat = os.stat(filename)
+    with open(filename, "rb") as f:
+        digest = zlib.crc32(f.read(INDEX_HASH_SPAN))
+        f.seek(max(INDEX_HASH_SPAN, stat.st_size - INDEX_HASH_SPAN))
+        digest = zlib.crc32(f.read(), digest)
+    return stat.st_size, stat.st_mtime_ns, digest
+
+
+def read_index():
+    "Returns the memory-mapped index of the source file, or None when there is none or when it is stale"
+    try:
+        with open(filename + ".gcidx", "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        return None
+    if len(data) < INDEX_HEADER.size or sys.byteorder != "little":
+        return None
+    magic, version, crlf, spiral, size, mtime, digest, maxZ, slicerMaxZ, count = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or (size, mtime, digest) != indexKey \
+            or len(data) != INDEX_HEADER.size + 17 * count:
+        return None
+    view = memoryview(data)[INDEX_HEADER.size:]
+    return {'eol': "\r\n" if crlf else "\n", 'spiral': bool(spiral), 'maxZ': maxZ, 'slicerMaxZ': slicerMaxZ or None,
+            'z': view[:8 * count].cast('d'), 'offset': view[8 * count:16 * count].cast('Q'), 'hop': view[16 * count:]}
+
+
+def write_index():
+    """
+    Analyses the source file and writes its index: the successive Z of the moves (without repeats), the offset of the
+    first of these moves in the (unpacked) file, whether this Z is only a hop (the next one goes back), and metadata
+    """
+    zs = []
+    offsets = []
+    base = 0
+    rest = b""
+    with open_gcode(filename, "r", inputCodec) as f:
+        while True:
+            data = f.read(PIPELINE_CHUNK)
+            final = not data
+            data = rest + data
+            cut = len(data) if final else data.rfind(b"\n") + 1
+            for m in moveZRegex.finditer(data, 0, cut):
+                z = float(m.group(1))
+                if not zs or zs[-1] != z:
+                    zs.append(z)
+                    offsets.append(base + m.start())
+            if final:
+                break
+            base += cut
+            rest = data[cut:]
+    hops = bytes(1 if 0 < i < len(zs) - 1 and zs[i - 1] < zs[i] and zs[i + 1] == zs[i - 1] else 0
+                 for i in range(len(zs)))
+    with open(filename + ".gcidx.tmp", "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, detect_eol() == "\r\n", spiral_vase(*gcode_ends()),
+                                  *indexKey, max(zs, default=0), slicer_max_z(*gcode_ends()) or 0, len(zs)))
+        f.write(struct.pack('<%id' % len(zs), *zs))
+        f.write(struct.pack('<%iQ' % len(zs), *offsets))
+        f.write(hops)
+    os.replace(filename + ".gcidx.tmp", filename + ".gcidx")
+
+
+gcodeIndex = None
+if useIndex and events is None:
+    indexKey = index_key()
+    gcodeIndex = read_index()
+    if gcodeIndex is None:
+        write_index()
+        gcodeIndex = read_index()
+
+
+def z_of_moves():
+    "Yields the Z of each move of the source file (moves without Z may be skipped, except the first one)"
+    z = 0
+    if events is not None:
+        for index, kind, lineZ in events:
+            if kind == 'g':
+                z = z if lineZ is None else lineZ
+                yield z
+    else:
+        # (only the total height is needed)
+        yield z
+        for z in gcodeIndex['z'] if gcodeIndex is not None else scan_z():
+            yield z
+
+
+# to stay consistent when we'll be adding our own lines
+eol = gcodeIndex['eol'] if gcodeIndex is not None else detect_eol()
+
+# Spiral (vase mode) prints rise a little with every move: the mix is then planned on a grid of spiralGrid mm
+spiralGrid = float(spiralGrid)
+if spiralGrid == 0:
+    spiral = gcodeIndex['spiral'] if gcodeIndex is not None else spiral_vase(*gcode_ends())
+    spiralGrid = 0.1 if spiral else -1
+
+
+def step_z(z):
+    "Returns the Z the mix is planned for: the step of the grid below it in spiral prints"
+    return math.floor(z / spiralGrid) * spiralGrid if spiralGrid > 0 else z
+
+
+# Find the total height of the object, and the successive Z heights the moves go through
 maxZ = 0
-z = 0
-for line in lines:
-    gv= get_value(line, 'G', None)
-    if gv is not None and (gv == 0 or gv == 1):
-        z = get_value(line, 'Z', z)
+zSteps = []
+followedMaxZ = 0  # highest move so far, in follow mode
+if following:
+    # only the head of the file is there: its height can not be checked against the last moves
+    with open_gcode(filename, "r", inputCodec) as f:
+        maxZ = (slicer_heights(f.read(FOLLOW_HEAD), b"") or [0])[0]
+    if not maxZ and mixCount == 0:
+        sys.stderr.write("No height found in the slicer header, waiting for the end of the file\n")
+        wait_for_source(float("inf"))
+        following = fixingUp = False
+if normalization == "header" and events is None and not following:
+    # (else the file is scanned)
+    maxZ = (gcodeIndex['slicerMaxZ'] if gcodeIndex is not None else slicer_max_z(*gcode_ends())) or 0
+if not maxZ and not following:
+    for z in z_of_moves():
+        if not zSteps or zSteps[-1] != step_z(z):
+            zSteps.append(step_z(z))
         if maxZ < z:
             maxZ = z
 
@@ -120,14 +1008,9 @@ lastMixes = [-1 for _ in range(mixCount)]
 speedRatio = [0.5 + random.randint(0,100)/100.0 for _ in range(mixCount)]
 mixOffsetDegrees = [360*random.randint(0,100)/100.0 for _ in range(mixCount)]
 
-# lines to remove from the source code
-regexToRemove = '^\s*(;mixing|'
-if toolCount > 0:
-    regexToRemove += 't[0-9]*$'
-else:
-    regexToRemove += 'm163|m164'
-regexToRemove += ')'
-
+# Statistics for --stats, gathered on the way: how many times each weight (or tool) was set, and the curve
+mixHistograms = [{} for _ in range(max(mixCount, 1))]
+mixCurve = []  # (z, weights or [tool]) after the last change at each Z
 
 def mix_cycle(normalizedIndex, speed, offsetDegree):
     "Returns a normalized cyclic value"
@@ -137,68 +1020,387 @@ def mix_cycle(normalizedIndex, speed, offsetDegree):
     return int(math.floor(100 * amplitude))
 
 
-file_out = open(filename, "w")
-with file_out as f:
-    f.write(";mixing : ")
+def mix_at(z):
+    "Returns the rounded mixing percentages for this Z (they sum up to 100), or None"
+    # z is not divided by maxZ as stripes thickness should stay independent of the geometry!
+    # compute all 3 offsets for this Z
+    mf = [0.0] * mixCount
+    t = 0.0
+    for i in range(mixCount):
+        a = mix_cycle(z * mixSpeed / 20, speedRatio[i], mixOffsetDegrees[i])
+        t += a
+        mf[i]= a
+    if not t:
+        return None
+    pcs = [0] * mixCount
+    fix = 0
+    for i in range(mixCount):
+        if i < mixCount - 1:
+            pc = round(100 * mf[i] / t)
+            fix += pc
+        else:
+            pc = 100 - fix
+        pcs[i] = pc
+    return pcs
+
+
+def record_change(z, channel, value, values):
+    "Accounts for a weight (or tool) that is set, for the statistics"
+    histogram = mixHistograms[channel]
+    histogram[value] = histogram.get(value, 0) + 1
+    if mixCurve and mixCurve[-1][0] == z:
+        mixCurve[-1] = (z, list(values))
+    else:
+        mixCurve.append((z, list(values)))
+
+
+def mix_command(pcs, z):
+    "Returns the M163/M164 commands that switch to these mixing percentages (empty when no change is big enough)"
+    if lastMixes[0] >= 0 and max(abs(pcs[i] - lastMixes[i]) for i in range(mixCount)) < mixResolution:
+        return ""
+    cmd = ""
+    for i in range(mixCount):
+        if pcs[i] != lastMixes[i]:
+            lastMixes[i] = pcs[i]
+            cmd += "M163 S{0} {1}".format(i, pcs[i]) + eol
+            if statsFilename:
+                record_change(z, i, pcs[i], lastMixes)
+    if cmd:
+        cmd += "M164 S0" + eol  # "store it" to virtual extruder 0 - Repetier hack?
+    return cmd
+
+
+planLastChangeZ = None
+
+
+def plan_step(z):
+    """
+    Decides whether the mix (or tool) should change when the moves reach a new Z, and returns the commands to insert
+    (or None). No change is less than mixResolution percent and changes are never closer than 1/maxChangeRate mm
+    of Z: they are postponed to a later step, so the gradient is still followed.
+    """
+    global lastExtruder, planLastChangeZ
+    minSpacing = 1.0 / maxChangeRate if maxChangeRate > 0 else 0
+    if planLastChangeZ is not None and abs(z - planLastChangeZ) < minSpacing:
+        return None  # too soon, the change is postponed to a later step
     if mixCount == 0:
-        f.write("switching among {0} tools, every {1:.2f}mm".format(toolCount, maxZ/toolCount))
+        # switches "tools", that need to be pre-configured for specific mixing levels
+        # The change in tool index is continuous so you can pre-define shades.
+        zn = z / maxZ  # we need a normalized value
+        # print("Z={0}".format(zn))
+        extruder = min(toolCount, int(toolCount * zn))  # (a followed print may rise above its header height)
+        if extruder != lastExtruder:
+            lastExtruder = extruder
+            planLastChangeZ = z
+            if statsFilename:
+                record_change(z, 0, extruder, [extruder])
+            return "T%i" % extruder + eol
     else:
-        f.write("mixing {0} materials along Z axis".format(mixCount))
-    f.write(" (total height is {0:.2f}mm)\n".format(maxZ))
-
-    for line in lines:
-        gv= get_value(line, 'G', None)
-        if gv is not None and (gv == 0 or gv == 1):
-            z = float(get_value(line,'Z',z))
-            if mixCount == 0:
-                # switches "tools", that need to be pre-configured for specific mixing levels
-                # The change in tool index is continuous so you can pre-define shades.
-                zn = z / maxZ  # we need a normalized value
-                # print("Z={0}".format(zn))
-                extruder = int(toolCount * zn)
-                if extruder != lastExtruder:
-                    lastExtruder = extruder
-                    f.write("T%i\n" % extruder)
+        pcs = mix_at(z)
+        if pcs is None:
+            return None
+        cmd = mix_command(pcs, z)
+        if cmd:
+            planLastChangeZ = z
+            return cmd
+    return None
+
+
+def plan_changes(steps):
+    "Plans the changes of the whole print at once, given the successive Z of the moves"
+    return [plan_step(z) for z in steps]
+
+
+#
+# Gradients along the path: the mix at some point of a layer is the mix of Z + pathSpeed * (the length extruded so
+# far in the layer). Long extruding moves are split in pieces, as few as the resolution allows (and never shorter
+# than minSegment), and each piece gets the mix of its middle, and its share of the Z change of the move (spiral
+# prints rise along the path). Mixes are cached on a 0.01mm grid.
+#
+moveRegex = re.compile(rb'([XYZEF])(-?[0-9]*\.?[0-9]+)')
+path = {'x': 0.0, 'y': 0.0, 'z': 0.0, 'e': 0.0, 'relativeE': False, 'relativeXY': False, 'layer': None,
+        'length': 0.0}
+pathMixes = {}
+
+
+def path_mix(position):
+    "Returns the (cached) mixing percentages at some position along the path"
+    key = int(round(position * 100))
+    if key not in pathMixes:
+        pathMixes[key] = mix_at(key / 100.0)
+    return pathMixes[key]
+
+
+def track_path(line):
+    "Follows the extrusion and positioning modes of the non-move lines"
+    code = line.split(b';')[0].strip().upper()
+    if code.startswith(b"M82"):
+        path['relativeE'] = False
+    elif code.startswith(b"M83"):
+        path['relativeE'] = True
+    elif code.startswith(b"G90"):
+        path['relativeXY'] = path['relativeE'] = False
+    elif code.startswith(b"G91"):
+        path['relativeXY'] = path['relativeE'] = True
+    elif code.startswith(b"G92"):
+        for key, value in moveRegex.findall(code):
+            path[key.decode().lower()] = float(value)
+
+
+def split_move(line, z):
+    "Returns the move, possibly split in pieces that come with their own mix so that colors also change along the path"
+    raw = dict((key.decode(), value.decode()) for key, value in moveRegex.findall(line.split(b';')[0]))
+    params = dict((key, float(value)) for key, value in raw.items())
+    if path['layer'] != z:
+        path['layer'] = z
+        path['length'] = 0.0  # new layer
+    x0, y0, z0, e0 = path['x'], path['y'], path['z'], path['e']
+    if path['relativeXY']:
+        path['x'] = x0 + params.get('X', 0)
+        path['y'] = y0 + params.get('Y', 0)
+        path['z'] = z0 + params.get('Z', 0)
+        return line  # not worth it
+    x = path['x'] = params.get('X', x0)
+    y = path['y'] = params.get('Y', y0)
+    z1 = path['z'] = params.get('Z', z0)
+    if 'E' not in params:
+        return line
+    e = params['E']
+    de = e if path['relativeE'] else e - e0
+    if not path['relativeE']:
+        path['e'] = e
+    length = math.hypot(x - x0, y - y0)
+    if de <= 0 or length <= 0:
+        return line
+
+    start = z + pathSpeed * path['length']
+    path['length'] += length
+    a = path_mix(start)
+    b = path_mix(start + pathSpeed * length)
+    if a is None or b is None:
+        return line
+    delta = max(abs(a[i] - b[i]) for i in range(mixCount))
+    count = max(1, min(int(length / minSegment), int(math.ceil(delta / mixResolution))))
+    out = b""
+    for i in range(count):
+        pcs = path_mix(start + pathSpeed * length * (i + 0.5) / count)
+        if pcs is not None:
+            out += mix_command(pcs, z).encode()
+        if i == count - 1 and not path['relativeE']:
+            out += line  # the last piece ends where the original move does
+        else:
+            t = (i + 1.0) / count
+            piece = "G1 X%.3f Y%.3f" % (x0 + t * (x - x0), y0 + t * (y - y0))
+            if 'Z' in params:
+                piece += " Z" + (raw['Z'] if i == count - 1 else "%.4f" % (z0 + t * (z1 - z0)))
+            piece += " E%.5f" % (de / count if path['relativeE'] else e0 + t * de)
+            if i == 0 and 'F' in params:
+                piece += " F%g" % params['F']
+            out += (piece + eol).encode()
+    return out
+
+
+def mixed_lines(source):
+    "Yields the g-code with the mixing commands, line by line (no line is read ahead, see the live mode)"
+    z = 0
+    stepZ = None
+    first = True
+    for line in source:
+        move = moveLineRegex.match(line)
+        if move:
+            if move.group(2):
+                z = step_z(float(move.group(2)))
+            if first or stepZ != z:
+                first = False
+                stepZ = z
+                if not pathSpeed:  # else mixes follow the path instead
+                    cmd = plan_step(z)
+                    if cmd:
+                        yield cmd.encode()
+
+            if pathSpeed:
+                yield split_move(line, z)  # (travels are followed too)
             else:
-                # z is not divided by maxZ as stripes thickness should stay independent of the geometry!
-                # compute all 3 offsets for this Z
-                mf = [0.0] * mixCount
-                t = 0.0
-                for i in range(mixCount):
-                    a = mix_cycle(z * mixSpeed / 20, speedRatio[i], mixOffsetDegrees[i])
-                    t += a
-                    mf[i]= a
-                if t:
-                    fix = 0
-                    didChange = 0
-                    for i in range(mixCount):
-                        if i < mixCount - 1:
-                            pc = round(100 * mf[i] / t)
-                            fix += pc
-                        else:
-                            pc = 100 - fix
-                        if pc != lastMixes[i]:
-                            lastMixes[i] = pc
-                            f.write("M163 S{0} {1}\n".format(i,pc))
-                            didChange = 1
-                    if didChange:
-                        f.write("M164 S0\n")  # "store it" to virtual extruder 0 - Repetier hack?
-                        if insertPlotData:
-                            # helps to plot the curves (grep + gnuplot), e.g. with:
-                            #
-                            # grep ';mixing_plot' $f |awk '{print $2 "\t" $3 "\t" $4 "\t" $5}' |sed '0,/^0/d' > /tmp/mix.dat
-                            # gnuplot -p -e 'set yrange [0 : 100]; plot
-                            #           "/tmp/mix.dat" using 1:2 title "C" with lines,
-                            #           "/tmp/mix.dat" using 1:3 title "Y" with lines,
-                            #           "/tmp/mix.dat" using 1:4 title "M" with lines'
-
-                            f.write(";mixing_plot\t{0}\t".format(z))
-                            for i in range(mixCount):
-                                f.write("{0}\t".format(lastMixes[i]))
-                            f.write("\n")
-
-            f.write(line)
+                yield line
 
         elif not re.search(regexToRemove, line, re.IGNORECASE):
             # discard any previous tool change
-            f.write(line)
+            if pathSpeed:
+                track_path(line)
+            yield line
+
+
+def mixed_shards():
+    "Yields the g-code with the mixing commands of the parallel mode, shard by shard"
+    changePlan = plan_changes(zSteps)
+    z = 0
+    step = -1
+    # replay mixed_lines() on the events only (the lines in between are kept as is)
+    before = {}
+    dropped = set()
+    for index, kind, lineZ in events:
+        if kind == 'r':
+            dropped.add(index)
+            continue
+        z = z if lineZ is None else step_z(lineZ)
+        if step < 0 or zSteps[step] != z:
+            step += 1
+            if changePlan[step]:
+                before[index] = changePlan[step].encode()
+
+    shardJobs = []
+    for start, end in shards:
+        shardJobs.append((start, end,
+                          dict((i, c) for i, c in before.items() if start <= i < end),
+                          set(i for i in dropped if start <= i < end)))
+    for text in pool.map(render_shard, shardJobs):
+        yield text
+    pool.close()
+
+
+HEIGHT_WIDTH = 12  # characters kept for the height in the header, when it is fixed up
+fixupPatches = []  # (offset, bytes) to write over the output, in follow mode
+
+
+def mixed_header(height, padded=False):
+    "Returns the comment at the top of the output, for the height of the print (None if unknown)"
+    header = ";mixing : "
+    if mixCount == 0:
+        header += "switching among {0} tools, every {1:.2f}mm".format(toolCount, maxZ/toolCount)
+        if following:
+            header += " up to {0:.2f}mm".format(maxZ)  # (the height of the slicer header, the print may differ)
+    else:
+        header += "mixing {0} materials along Z axis".format(mixCount)
+    header += " (total height is {0})".format("unknown" if height is None else "{0:.2f}mm".format(height))
+    if padded:  # to the same width whatever the height, so that it can be written again
+        header = header.ljust(len(mixed_header(None)) - len(eol) + HEIGHT_WIDTH)
+    return header + eol
+
+
+def mixed():
+    "Yields the whole g-code with the mixing commands"
+    global maxZ
+    if fixingUp:
+        yield mixed_header(None, True).encode()  # written again at the end
+    elif following and not maxZ:
+        yield mixed_header(None).encode()
+    else:
+        yield mixed_header(maxZ).encode()
+
+    if events is not None:
+        for text in mixed_shards():
+            yield text
+    else:
+        for text in mixed_lines(gcode_lines()):
+            yield text
+    if following:
+        if mixCount:
+            maxZ = followedMaxZ
+        if fixingUp:
+            fixupPatches.append((0, mixed_header(followedMaxZ, True).encode()))
+
+
+#
+# With --checksum, each command gets a line number and a checksum (N<line> command*<checksum>) the way serial hosts
+# add them, after a line number reset (M110), so that a host can send the lines as they are. Comments that follow
+# commands are dropped from these lines. --strip-comments drops all the comments, and the empty lines.
+#
+def numbered_line(number, command):
+    "Returns a command with its line number and its checksum, as RepRap firmwares check them"
+    line = b"N%i %s" % (number, command)
+    checksum = 0
+    for c in line:
+        checksum ^= c
+    return b"%s*%i" % (line, checksum)
+
+
+def serial_lines(pieces):
+    "Yields the output as a serial host sends it (see above), piece by piece"
+    newline = eol.encode()
+    number = 0
+    if checksumLines:
+        yield numbered_line(number, b"M110 N0") + newline
+    for piece in pieces:
+        out = []
+        for line in piece.splitlines():
+            command = line.split(b";", 1)[0].strip()
+            if not command:
+                if not stripComments:
+                    out.append(line)
+            elif checksumLines:
+                number += 1
+                out.append(numbered_line(number, command))
+            else:
+                out.append(command)
+        if out:
+            yield newline.join(out) + newline
+
+
+output = serial_lines(mixed()) if checksumLines or stripComments else mixed()
+
+if live:
+    # Stream to the standard output as soon as lines are ready, e.g. for a print server that sends them to a printer
+    for text in output:
+        sys.stdout.buffer.write(text)
+        sys.stdout.buffer.flush()
+else:
+    # write aside, so that the source can be streamed while patching it in place
+    tmpFilename = outputFilename + ".tmp"
+    try:
+        with PipelinedWriter(open_gcode(tmpFilename, "w", outputCodec, outputLevel, filename)) as f:
+            for text in output:
+                f.write(text)
+        if fixupPatches:
+            with open(tmpFilename, "r+b") as f:
+                for offset, data in fixupPatches:
+                    f.seek(offset)
+                    f.write(data)
+    except BaseException:
+        if os.path.exists(tmpFilename):
+            os.remove(tmpFilename)
+        raise
+    os.replace(tmpFilename, outputFilename)
+    if os.path.exists(outputFilename + ".gcidx"):
+        os.remove(outputFilename + ".gcidx")  # (it described the file before, e.g. the source patched in place)
+
+
+def channel_stats(histogram):
+    "Returns the count, min, max, average and median of the values set on a channel"
+    count = sum(histogram.values())
+    if not count:
+        return [0, None, None, None, None]
+    values = sorted(histogram)
+    total = sum(value * n for value, n in histogram.items())
+
+    def nth(rank):
+        for value in values:
+            rank -= histogram[value]
+            if rank < 0:
+                return value
+
+    if count % 2:
+        median = nth(count // 2)
+    else:
+        median = (nth(count // 2) + nth(count // 2 - 1)) / 2.0
+    return [count, values[0], values[-1], round(float(total) / count, 3), median]
+
+
+# Write the statistics aside (no comment is added to the g-code, and the output is not read again)
+if statsFilename:
+    channels = ["T"] if mixCount == 0 else ["S%i" % i for i in range(mixCount)]
+    statsNames = ["count", "min", "max", "average", "median"]
+    with open(statsFilename, "w") as f:
+        if statsFilename.lower().endswith(".json"):
+            json.dump({"source": filename, "maxZ": maxZ,
+                       "channels": dict((name, dict(zip(statsNames, channel_stats(histogram))))
+                                        for name, histogram in zip(channels, mixHistograms)),
+                       "curve": [[z] + values for z, values in mixCurve]}, f)
+            f.write("\n")
+        else:
+            # statistics as comments first (e.g. gnuplot skips them), then the curve
+            for name, histogram in zip(channels, mixHistograms):
+                f.write("# %s: %s\n" % (name, " ".join("%s %s" % (statName, value) for statName, value in
+                                                       zip(statsNames, channel_stats(histogram)))))
+            f.write(",".join(["z"] + channels) + "\n")
+            for z, values in mixCurve:
+                f.write(",".join("%g" % v for v in [z] + values) + "\n")
@@ -0,0 +1,37 @@
+#!/bin/bash
+# Checks that the height of the slicer header is not trusted when a move of the start script goes higher (;MAXZ:10
+# then G1 Z15.0): the tools are spread on the scanned height, whatever the normalization or the count of jobs.
+set -e
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+python - > "$tmp/lift.gcode" <<'PY'
+print(";MAXZ:10\nG21\nG90\nG28\nG1 Z15.0 F9000 ;move the platform down 15mm\nG92 E0")
+e = 0.0
+for layer in range(50):
+    print(";LAYER:%i\nG0 X10 Y10 Z%.1f" % (layer, (layer + 1) * 0.2))
+    for corner in range(400):  # (enough for the start to be out of the tail the header height is checked on)
+        e += 0.5
+        print("G1 X%i Y%i E%.1f" % (10 + 10 * (corner % 2), 10 + 10 * (corner // 4 % 2), e))
+print("M104 S0")
+PY
+
+expected=""
+for options in "" "--normalize scan" "--normalize header" "--jobs 3"; do
+	cp "$tmp/lift.gcode" "$tmp/in.gcode"
+	python ../colormix.py --file "$tmp/in.gcode" --output "$tmp/out.gcode" --mix 0 --extruders 10 $options > /dev/null
+	result="$(head -1 "$tmp/out.gcode" | tr -d '\r') / $(grep -o '^T[0-9]*' "$tmp/out.gcode" | tr '\n' ' ')"
+	echo "${options:-(default)}: $result"
+	if [[ -z $expected ]]; then
+		expected=$result
+	elif [[ $result != "$expected" ]]; then
+		echo "FAILED: not the same as the default"
+		exit 1
+	fi
+done
+if [[ $expected != *"total height is 15.00mm"* ]]; then
+	echo "FAILED: the lift of the start script is missed"
+	exit 1
+fi
+echo OK
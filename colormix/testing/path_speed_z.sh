@@ -0,0 +1,40 @@
+#!/bin/bash
+# Checks that --path-speed keeps the rise of spiral (vase mode) prints: the moves along Z of a synthetic vase, with
+# absolute (M82) then relative (M83) extrusion, are counted before and after splitting the moves along the path.
+set -e
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+
+for mode in M82 M83; do
+	python - "$mode" > "$tmp/vase_$mode.gcode" <<'PY'
+import math, sys
+relative = sys.argv[1] == "M83"
+print("; spiral_vase = 1\nG21\nG90\n%s\nG92 E0\nG1 Z0.2 F3000" % sys.argv[1])
+e = 0.0
+for i in range(2000):
+    angle = i * 2 * math.pi / 100
+    e += 0.05
+    print("G1 X%.3f Y%.3f Z%.4f E%.5f" % (100 + 20 * math.cos(angle), 100 + 20 * math.sin(angle), 0.2 + i * 0.001,
+                                        0.05 if relative else e))
+PY
+	python ../colormix.py --file "$tmp/vase_$mode.gcode" --output "$tmp/out_$mode.gcode" --mix 3 --path-speed 20 \
+		--min-segment 0.2 > /dev/null
+	before=$(grep -c '^G1 .*Z' "$tmp/vase_$mode.gcode")
+	after=$(grep -c '^G1 .*Z' "$tmp/out_$mode.gcode")
+	pieces=$(grep -c '^G1 ' "$tmp/out_$mode.gcode")
+	echo "$mode: $before moves along Z before, $after after (out of $pieces moves)"
+	# every piece of a rising move rises too, and the top is the same
+	grep -o 'Z[0-9.]*' "$tmp/out_$mode.gcode" | tr -d Z | awk -v mode=$mode '
+		$1 < last { print mode ": Z goes down from " last " to " $1; exit 1 } { last = $1 }'
+	if [[ $after -lt $before ]]; then
+		echo "$mode: moves along Z were lost"
+		exit 1
+	fi
+	if [[ $after -ne $pieces ]]; then
+		echo "$mode: some pieces do not rise (stair-steps)"
+		exit 1
+	fi
+	[[ $(grep -o 'Z[0-9.]*' "$tmp/vase_$mode.gcode" | tail -1) == $(grep -o 'Z[0-9.]*' "$tmp/out_$mode.gcode" | tail -1) ]]
+done
+echo "OK"
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# Spreads the post-processing of g-code files (with wood.py, colormix.py or any script that accepts --file and
+# --output) over several hosts: a coordinator hands the files out to workers that connect to it over TCP.
+#
+# Run the coordinator like:
+#   distribute.py --listen 0.0.0.0:7070 --ready /srv/ready big.gcode other.gcode -- --grain 5
+# and as many workers as wanted, on any host, each with its own processor:
+#   distribute.py --connect coordinator:7070 (--jobs 4) -- ../wood/wood.py
+#
+# The coordinator only sends the options of the processor, never a command: a worker runs nothing but the processor
+# given on its own command line. There is no authentication, so the coordinator listens on 127.0.0.1 unless told
+# otherwise: only open it to a network where every host may read the files and pose as a worker.
+#
+# Files are handed out biggest first, so that small files fill the gaps at the end. Files bigger than --big MB are
+# kept for the workers with the most --jobs (as long as there are other files for the weaker ones), and these run
+# the processor with its own --jobs. The coordinator exits once every file is processed, and tells the workers to.
+#
+# Both ways, files are streamed through the connection by chunks (the worker keeps them in a temporary directory
+# while the processor runs). When a worker dies or loses its connection during a job, or when the processor fails,
+# the file goes back to the queue, up to --retries more times. Results are written in the --ready directory.
+#
+# The protocol is made of JSON lines, followed by the "size" bytes of a file for the messages that carry one:
+#   worker: {"worker": name, "jobs": n}                                          once connected
+#   coordinator: {"job": id, "name": fileName, "options": [...], "jobs": n, "size": bytes}, then the file
+#     or {"quit": true}
+#   worker: {"done": id, "status": exitCode, "seconds": s, "size": bytes}, then the output (or the error messages)
+
+import sys
+import os
+import getopt
+import inspect
+import json
+import shutil
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+CHUNK = 1 << 20  # bytes
+
+
+def usage(myName):
+    print("Usage:")
+    print("  " + myName + " --listen ([host]:)port --ready outputDir (--retries count) (--big MB) gcodeFile..."
+          + " (-- processor options)")
+    print("  " + myName + " --connect host:port (--jobs processCount) (--name workerName) -- processor.py")
+    print("  " + myName + " -L ([host]:)port -r outputDir (-R count) (-b MB) gcodeFile... (-- processor options)")
+    print("  " + myName + " -c host:port (-j processCount) (-n workerName) -- processor.py")
+    print("  (the host the coordinator listens on is 127.0.0.1 by default)")
+    sys.exit()
+
+
+def address(text, defaultHost):
+    "Returns the (host, port) of a [host:]port text"
+    host, sep, port = text.rpartition(":")
+    return host or defaultHost, int(port)
+
+
+def send_message(f, message, source=None):
+    "Sends a message, then the (message's) size bytes of a binary stream when given"
+    f.write((json.dumps(message) + "\n").encode())
+    if source is not None:
+        copy_bytes(source, f, message["size"])
+    f.flush()
+
+
+def receive_message(f):
+    line = f.readline()
+    if not line.endswith(b"\n"):
+        raise EOFError("connection lost")
+    return json.loads(line.decode())
+
+
+def copy_bytes(source, destination, size):
+    "Copies exactly size bytes from a stream to another, by chunks"
+    while size > 0:
+        data = source.read(min(CHUNK, size))
+        if not data:
+            raise EOFError("connection lost")
+        destination.write(data)
+        size -= len(data)
+
+
+#
+# Coordinator side
+#
+pending = []  # jobs not handed out yet, biggest first
+inFlight = 0
+failed = []
+workerJobs = {}  # connected worker -> its process count
+jobsChanged = threading.Condition()
+
+
+def queue_job(job):
+    "Puts a job back in the queue, at its place by size"
+    index = 0
+    while index < len(pending) and pending[index]["size"] >= job["size"]:
+        index += 1
+    pending.insert(index, job)
+
+
+def next_job(jobs):
+    "Waits for a job for a worker that runs that many processes, or returns None once everything is done"
+    global inFlight
+    with jobsChanged:
+        while not pending and inFlight:
+            jobsChanged.wait()
+        if not pending:
+            return None
+        job = pending[0]
+        if job["size"] > bigSize and jobs < max(workerJobs.values()):
+            smaller = [j for j in pending if j["size"] <= bigSize]
+            if smaller:
+                job = smaller[0]  # leave the big ones for the stronger workers
+        pending.remove(job)
+        inFlight += 1
+        return job
+
+
+def end_job(job, success, reason=""):
+    "Accounts for the end of a job, that is queued again when it failed and may still be retried"
+    global inFlight
+    with jobsChanged:
+        inFlight -= 1
+        if not success:
+            job["attempts"] += 1
+            if job["attempts"] <= retries:
+                print("retrying %s (%s)" % (job["name"], reason))
+                queue_job(job)
+            else:
+                print("FAILED %s (%s)" % (job["name"], reason))
+                failed.append(job)
+        jobsChanged.notify_all()
+
+
+class CoordinatorHandler(socketserver.StreamRequestHandler):
+    "Feeds a connected worker with jobs until there are no more"
+
+    def handle(self):
+        hello = receive_message(self.rfile)
+        worker = "%s (%s:%i)" % ((hello.get("worker", "?"),) + self.client_address[:2])
+        jobs = max(1, int(hello.get("jobs", 1)))
+        with jobsChanged:
+            workerJobs[worker] = jobs
+        print("worker %s connected, %i processes" % (worker, jobs))
+        try:
+            while True:
+                job = next_job(jobs)
+                if job is None:
+                    send_message(self.wfile, {"quit": True})
+                    return
+                self.run_job(worker, job, jobs)
+        except (OSError, EOFError, ValueError):
+            pass  # the worker is gone (its job is queued again)
+        finally:
+            with jobsChanged:
+                del workerJobs[worker]
+                jobsChanged.notify_all()
+            print("worker %s disconnected" % worker)
+
+    def run_job(self, worker, job, jobs):
+        startedAt = time.time()
+        tmpFilename = os.path.join(readyDir, "." + job["name"] + ".tmp")
+        try:
+            with open(job["path"], "rb") as source:
+                send_message(self.wfile, {"job": job["id"], "name": job["name"], "options": processorOptions,
+                                          "jobs": jobs if job["size"] > bigSize else 1, "size": job["size"]}, source)
+            reply = receive_message(self.rfile)
+            if reply.get("status") == 0:
+                with open(tmpFilename, "wb") as f:
+                    copy_bytes(self.rfile, f, reply["size"])
+                os.replace(tmpFilename, os.path.join(readyDir, job["name"]))
+            else:
+                errors = self.rfile.read(reply["size"]).decode(errors="replace").strip().splitlines()
+        except BaseException:
+            if os.path.exists(tmpFilename):
+                os.remove(tmpFilename)
+            end_job(job, False, "lost worker " + worker)
+            raise
+        if reply.get("status") != 0:
+            end_job(job, False, "status %s on %s: %s" % (reply.get("status"), worker, (errors or ["?"])[-1]))
+            return
+        end_job(job, True)
+        print("done %s: %i bytes on %s in %.2fs (processing %.2fs)"
+              % (job["name"], job["size"], worker, time.time() - startedAt, reply.get("seconds", 0)))
+
+
+class Coordinator(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def coordinate(listen, files):
+    for index, path in enumerate(files):
+        queue_job({"id": index, "path": path, "name": os.path.basename(path), "size": os.path.getsize(path),
+                   "attempts": 0})
+    server = Coordinator(address(listen, "127.0.0.1"), CoordinatorHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print("coordinator listening on %s:%i, %i files to process" % (server.server_address[:2] + (len(files),)))
+    try:
+        with jobsChanged:
+            while pending or inFlight:
+                jobsChanged.wait()
+            # let the waiting workers know they can quit
+            jobsChanged.notify_all()
+            deadline = time.time() + 5
+            while workerJobs and time.time() < deadline:
+                jobsChanged.wait(deadline - time.time())
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    server.server_close()
+    print("%i files processed, %i failed" % (len(files) - len(failed), len(failed)))
+    return 1 if failed or pending else 0
+
+
+#
+# Worker side
+#
+def work(connect, jobs, name, processor):
+    connection = socket.create_connection(address(connect, "localhost"))
+    f = connection.makefile("rwb")
+    send_message(f, {"worker": name, "jobs": jobs})
+    workDir = tempfile.mkdtemp(prefix="distribute-")
+    try:
+        while True:
+            message = receive_message(f)
+            if message.get("quit"):
+                return
+            source = os.path.join(workDir, os.path.basename(message["name"]))
+            output = os.path.join(workDir, "out", os.path.basename(message["name"]))
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            with open(source, "wb") as g:
+                copy_bytes(f, g, message["size"])
+            command = processor + [str(option) for option in message.get("options", [])]
+            if processor[0].endswith(".py"):
+                command = [sys.executable] + command
+            if message.get("jobs", 1) > 1:
+                command = command + ["--jobs", str(message["jobs"])]
+            startedAt = time.time()
+            run = subprocess.run(command + ["--file", source, "--output", output],
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            seconds = time.time() - startedAt
+            print("%s %s: %i bytes in %.2fs" % ("done" if run.returncode == 0 else "FAILED", message["name"],
+                                                message["size"], seconds))
+            if run.returncode == 0:
+                with open(output, "rb") as g:
+                    send_message(f, {"done": message["job"], "status": 0, "seconds": seconds,
+                                     "size": os.path.getsize(output)}, g)
+            else:
+                send_message(f, {"done": message["job"], "status": run.returncode, "seconds": seconds,
+                                 "size": len(run.stderr)})
+                f.write(run.stderr)
+                f.flush()
+            for path in (source, output):
+                if os.path.exists(path):
+                    os.remove(path)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+        connection.close()
+
+
+if __name__ == "__main__":
+    opts, args = getopt.getopt(sys.argv[1:], 'L:r:R:b:c:j:n:h',
+                               ['listen=', 'ready=', 'retries=', 'big=', 'connect=', 'jobs=', 'name=', 'help'])
+    listen = ""
+    readyDir = ""
+    retries = 2
+    bigSize = 64 << 20
+    connect = ""
+    jobs = 1
+    name = socket.gethostname()
+    for o, p in opts:
+        if o in ['-L', '--listen']:
+            listen = p
+        elif o in ['-r', '--ready']:
+            readyDir = p
+        elif o in ['-R', '--retries']:
+            retries = int(p)
+        elif o in ['-b', '--big']:
+            bigSize = int(float(p) * (1 << 20))
+        elif o in ['-c', '--connect']:
+            connect = p
+        elif o in ['-j', '--jobs']:
+            jobs = int(p)
+        elif o in ['-n', '--name']:
+            name = p
+        elif o in ['-h', '--help']:
+            usage(inspect.stack()[0][1])
+
+    if connect:
+        processor = args[args.index("--") + 1:] if "--" in args else args
+        if not processor:
+            usage(inspect.stack()[0][1])
+        work(connect, jobs, name, processor)
+    else:
+        files = args[:args.index("--")] if "--" in args else args
+        processorOptions = args[len(files) + 1:]
+        if not listen or not readyDir or not files:
+            usage(inspect.stack()[0][1])
+        if not os.path.isdir(readyDir):
+            os.makedirs(readyDir)
+        sys.exit(coordinate(listen, files))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# Stands for a printer at the end of a pipe, to check how soon a post-processor in --live mode starts to send g-code.
+#
+# Run it like:
+#   ../wood/wood.py --live --file print.gcode | fake_printer.py --rate 200
+#
+# Lines are read from the standard input (comments and empty lines are not "sent"). With --rate, the printer only
+# accepts that many commands per second, as a serial link with its "ok" acknowledgements would. The time to the
+# first command, and the command rate, are reported when the input ends.
+
+import sys
+import getopt
+import inspect
+import time
+
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+def usage(myName):
+    print("Usage:")
+    print("  " + myName + " (--rate commandsPerSecond) (--quiet)")
+    print("  " + myName + " (-r commandsPerSecond) (-q)")
+    sys.exit()
+
+
+opts, args = getopt.getopt(sys.argv[1:], 'r:qh', ['rate=', 'quiet', 'help'])
+rate = 0.0
+quiet = False
+for o, p in opts:
+    if o in ['-r', '--rate']:
+        rate = float(p)
+    elif o in ['-q', '--quiet']:
+        quiet = True
+    elif o in ['-h', '--help']:
+        usage(inspect.stack()[0][1])
+
+startedAt = time.time()
+firstAt = None
+commands = 0
+lines = 0
+for line in sys.stdin.buffer:  # (as bytes, like the post-processors: comments may be in any encoding)
+    lines += 1
+    command = line.split(b";", 1)[0].strip()
+    if not command:
+        continue
+    now = time.time()
+    if firstAt is None:
+        firstAt = now
+        if not quiet:
+            sys.stderr.write("first command after %.3fs: %s\n" % (firstAt - startedAt, command.decode("latin_1")))
+    commands += 1
+    if rate > 0:
+        # wait for the "ok" of the printer
+        late = firstAt + commands / rate - now
+        if late > 0:
+            time.sleep(late)
+endedAt = time.time()
+
+if firstAt is None:
+    sys.stderr.write("no command received in %.3fs\n" % (endedAt - startedAt))
+    sys.exit(1)
+sys.stderr.write("%i commands (%i lines) in %.3fs: first after %.3fs, %.0f commands/s\n"
+                 % (commands, lines, endedAt - startedAt, firstAt - startedAt,
+                    commands / max(endedAt - firstAt, 1e-6)))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# Watches a spool directory where slicers drop g-code files, and post-processes each new file (with wood.py,
+# colormix.py or any script that accepts --file and --output) as soon as it is completely written.
+#
+# Run it like:
+#   watch.py --spool /srv/spool --ready /srv/ready -- ../wood/wood.py --grain 5 --random-seed 3
+#
+# A file is processed once its size and modification time did not change for --settle seconds (so half-written
+# files are left alone). Up to --workers files are processed at once; when --queue stable files are already waiting,
+# the spool is not scanned any further until workers catch up. Results are written in the --ready directory (under
+# the same name), sources are moved to the "done" (or "failed") sub-directory of the spool.
+#
+# Each processed file is logged with its latencies (seconds): since the last write by the slicer, waiting for the
+# file to settle, waiting for a worker, and processing. Use --log to append them to a CSV file too.
+
+import sys
+import os
+import getopt
+import inspect
+import shutil
+import subprocess
+import threading
+import time
+
+try:
+    import queue  # python 3
+except ImportError:
+    import Queue as queue
+
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+
+def usage(myName):
+    print("Usage:")
+    print("  " + myName + " --spool spoolDir --ready outputDir (--workers count) (--queue count) (--settle seconds)"
+          + " (--poll seconds) (--log csvFile) (--once) -- processor.py (processor options)")
+    print("  " + myName + " -s spoolDir -r outputDir (-w count) (-q count) (-t seconds) (-p seconds) (-l csvFile) (-1)"
+          + " -- processor.py (processor options)")
+    sys.exit()
+
+
+opts, processor = getopt.getopt(sys.argv[1:], 's:r:w:q:t:p:l:1h',
+                                ['spool=', 'ready=', 'workers=', 'queue=', 'settle=', 'poll=', 'log=', 'once', 'help'])
+spoolDir = ""
+readyDir = ""
+workers = 2
+queueSize = 4
+settleTime = 2.0
+pollTime = 0.5
+logFilename = ""
+once = False
+for o, p in opts:
+    if o in ['-s', '--spool']:
+        spoolDir = p
+    elif o in ['-r', '--ready']:
+        readyDir = p
+    elif o in ['-w', '--workers']:
+        workers = int(p)
+    elif o in ['-q', '--queue']:
+        queueSize = int(p)
+    elif o in ['-t', '--settle']:
+        settleTime = float(p)
+    elif o in ['-p', '--poll']:
+        pollTime = float(p)
+    elif o in ['-l', '--log']:
+        logFilename = p
+    elif o in ['-1', '--once']:
+        once = True
+    elif o in ['-h', '--help']:
+        usage(inspect.stack()[0][1])
+if not spoolDir or not readyDir or not processor:
+    usage(inspect.stack()[0][1])
+
+doneDir = os.path.join(spoolDir, "done")
+failedDir = os.path.join(spoolDir, "failed")
+for d in (readyDir, doneDir, failedDir):
+    if not os.path.isdir(d):
+        os.makedirs(d)
+
+if processor[0].endswith(".py"):
+    processor = [sys.executable] + processor
+
+pending = queue.Queue(maxsize=queueSize)  # stable files waiting for a worker (bounded: this is the backpressure)
+inProgress = set()  # names queued or being processed, so they are not picked twice
+lock = threading.Lock()
+
+if logFilename and not os.path.isfile(logFilename):
+    with open(logFilename, "w") as log:
+        log.write("file,bytes,status,since_written,settling,queued,processing\n")
+
+
+def process(name, stat, seenAt, stableAt):
+    "Runs the processor on a spool file, then moves the source away and logs the latencies"
+    source = os.path.join(spoolDir, name)
+    startedAt = time.time()
+    status = subprocess.call(processor + ["--file", source, "--output", os.path.join(readyDir, name)])
+    endedAt = time.time()
+    shutil.move(source, os.path.join(doneDir if status == 0 else failedDir, name))
+    with lock:
+        inProgress.discard(name)
+
+    latencies = (endedAt - stat.st_mtime, stableAt - seenAt, startedAt - stableAt, endedAt - startedAt)
+    print("%s %s: %i bytes, %.2fs since written (settling %.2fs, queued %.2fs, processing %.2fs)"
+          % (("done" if status == 0 else "FAILED", name, stat.st_size) + latencies))
+    if logFilename:
+        with lock:
+            with open(logFilename, "a") as log:
+                log.write("%s,%i,%i,%.3f,%.3f,%.3f,%.3f\n" % ((name, stat.st_size, status) + latencies))
+
+
+def worker():
+    while True:
+        job = pending.get()
+        if job is None:
+            return
+        try:
+            process(*job)
+        except Exception as e:
+            # (e.g. the processor is missing) the file goes aside, and the worker goes on with the next ones
+            name = job[0]
+            print("FAILED %s: %s" % (name, e))
+            source = os.path.join(spoolDir, name)
+            try:
+                if os.path.exists(source):
+                    shutil.move(source, os.path.join(failedDir, name))
+            except (IOError, OSError) as e:
+                print("could not move %s aside: %s" % (name, e))
+            with lock:
+                inProgress.discard(name)
+        finally:
+            pending.task_done()
+
+
+threads = [threading.Thread(target=worker) for _ in range(workers)]
+for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+candidates = {}  # name -> (size, mtime, first seen, last change seen)
+try:
+    while True:
+        now = time.time()
+        names = set()
+        for name in sorted(os.listdir(spoolDir)):
+            path = os.path.join(spoolDir, name)
+            if name.startswith(".") or name.endswith(".tmp") or not os.path.isfile(path):
+                continue  # hidden or temporary files are being written
+            with lock:
+                if name in inProgress:
+                    continue
+            names.add(name)
+            stat = os.stat(path)
+            known = candidates.get(name)
+            if known is None or known[0] != stat.st_size or known[1] != stat.st_mtime:
+                candidates[name] = (stat.st_size, stat.st_mtime, known[2] if known else now, now)
+            elif stat.st_size and now - known[3] >= settleTime and now - stat.st_mtime >= settleTime:
+                with lock:
+                    inProgress.add(name)
+                del candidates[name]
+                pending.put((name, stat, known[2], now))  # blocks while the queue is full
+        for name in list(candidates):
+            if name not in names:
+                del candidates[name]  # vanished
+        if once and not candidates:
+            with lock:
+                if not inProgress:
+                    break
+        time.sleep(pollTime)
+except KeyboardInterrupt:
+    pass
+
+for thread in threads:
+    pending.put(None)
+for thread in threads:
+    thread.join()
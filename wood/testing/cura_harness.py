@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# Runs the Cura plugin (../Woodgrain_Cura.py) without Cura: Cura, Uranium and Qt are replaced by small stand-ins, and
+# the plugin gets the per-layer "data" list Cura would give it, built from a test file repeated along Z.
+#
+# Run it like:
+#   cura_harness.py (--fixture wood_cylinder_source.gcode) (--scales 1,4,16) (--seed 1) (--no-memory) (--no-compare)
+#
+# For each scale, execute() is timed as Cura would call it (throughput of the whole call, and of the processing
+# thread alone), with the peak of memory allocated by Python (a second run, under tracemalloc), the lock
+# acquisitions, and how the UI loop of execute() behaves: how often it lets Qt process events (the longest gap
+# freezes the UI) and how late it returns once the processing thread is done. The output is compared with that of
+# ../wood.py run on the same g-code with the same settings and random seed (see comparable() for the known
+# differences that are left aside).
+
+import sys
+import os
+import getopt
+import inspect
+import importlib.util
+import itertools
+import json
+import random
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+__license__ = 'GNU Affero General Public License http://www.gnu.org/licenses/agpl.html'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGIN = os.path.join(HERE, "..", "Woodgrain_Cura.py")
+WOOD = os.path.join(HERE, "..", "wood.py")
+
+# wood.py options for the settings of the plugin
+WOOD_OPTIONS = {"minTemp": "--min", "maxTemp": "--max", "firstTemp": "--first-temp", "grainSize": "--grain",
+                "maxUpward": "--max-upward", "maxDownward": "--max-downward", "spikinessPower": "--spikiness-power",
+                "zOffset": "--z-offset", "scanForZHop": "--scan-for-z-hop"}
+
+
+#
+# Stand-ins for the modules of Cura, Uranium and Qt the plugin imports
+#
+class Logger:
+    messages = []
+
+    @staticmethod
+    def log(level, message):
+        Logger.messages.append((level, message))
+
+
+class Message:
+    def __init__(self, title="", text="", lifetime=0, dismissable=True, progress=None):
+        self.progress = progress
+
+    def show(self):
+        pass
+
+    def hide(self):
+        pass
+
+    def setProgress(self, progress):
+        self.progress = progress
+
+
+class QCoreApplication:
+    calls = []  # times of the calls
+
+    @staticmethod
+    def processEvents():
+        QCoreApplication.calls.append(time.perf_counter())
+
+
+class QtApplication:
+    @staticmethod
+    def getInstance():
+        return QtApplication
+
+    @staticmethod
+    def getMainWindow():
+        return QtApplication  # Cura is still open
+
+
+class Script:
+    "The base class of Cura post-processing scripts, that returns the default values of their settings"
+
+    def __init__(self):
+        settings = json.loads(self.getSettingDataString())["settings"]
+        self.settingValues = dict((key, setting["value"]) for key, setting in settings.items())
+
+    def getSettingValueByKey(self, key):
+        return self.settingValues[key]
+
+
+class CountingLock:
+    "A lock that counts its acquisitions"
+    acquisitions = itertools.count()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def acquire(self, *args):
+        next(CountingLock.acquisitions)
+        return self.lock.acquire(*args)
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def stub_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__path__ = []  # may be a package too
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def load_plugin():
+    "Imports the plugin as Cura does (from the scripts of its PostProcessingPlugin), against the stand-ins"
+    stub_module("PostProcessingPlugin")
+    stub_module("PostProcessingPlugin.scripts")
+    stub_module("PostProcessingPlugin.Script", Script=Script)
+    stub_module("UM")
+    stub_module("UM.Logger", Logger=Logger)
+    stub_module("UM.Message", Message=Message)
+    stub_module("UM.Qt")
+    stub_module("UM.Qt.QtApplication", QtApplication=QtApplication)
+    stub_module("PyQt6")
+    stub_module("PyQt6.QtCore", QCoreApplication=QCoreApplication)
+    spec = importlib.util.spec_from_file_location("PostProcessingPlugin.scripts.Woodgrain_Cura", PLUGIN)
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    plugin.threading = types.SimpleNamespace(Lock=CountingLock, Thread=threading.Thread)
+    return plugin
+
+
+#
+# Cura-style input: the start g-code, then one string per layer (the last one has the end g-code)
+#
+def cura_data(fixture, scale):
+    "Returns the data list of the fixture file with its layers repeated scale times, each time higher"
+    with open(fixture) as f:
+        text = f.read()
+    start = text.index(";LAYER:0")
+    end = text.index(";End GCode") if ";End GCode" in text else len(text)
+    layers = re.split(r'(?m)^(?=;LAYER:)', text[start:end])[1:]
+    height = max(float(z) for z in re.findall(r'(?m)^G[01] [^;\n]*Z([0-9.]+)', text[start:end]))
+    data = [text[:start]]
+    for copy in range(scale):
+        for layer in layers:
+            layer = re.sub(r'(?m)^(G[01] [^;\n]*Z)([0-9.]+)',
+                           lambda m: "%s%.3f" % (m.group(1), float(m.group(2)) + copy * height), layer)
+            data.append(re.sub(r'^;LAYER:[0-9]+', ";LAYER:%i" % (len(data) - 1), layer))
+    data[-1] += text[end:]
+    return data
+
+
+def run_plugin(plugin, data, seed):
+    "Runs execute() as Cura does, and returns the output with the measures"
+    instance = plugin.Woodgrain_Cura()
+    processing = {}
+    applyWoodgrain = instance.apply_woodgrain
+
+    def timed_apply(data):
+        processing["start"] = time.perf_counter()
+        applyWoodgrain(data)
+        processing["end"] = time.perf_counter()
+
+    instance.apply_woodgrain = timed_apply
+    QCoreApplication.calls = []
+    CountingLock.acquisitions = itertools.count()
+    random.seed(seed)  # as wood.py --random-seed does, for the permutation of the Perlin noise
+    startedAt = time.perf_counter()
+    try:
+        output = instance.execute(data)
+    except Exception as e:
+        instance.apply_woodgrain_thread.join()
+        return None, {"error": "execute() failed: %s: %s" % (type(e).__name__, e)}
+    endedAt = time.perf_counter()
+    calls = QCoreApplication.calls
+    gaps = [b - a for a, b in zip(calls, calls[1:])] or [0]
+    return output, {"seconds": endedAt - startedAt, "processing": processing["end"] - processing["start"],
+                    "late": endedAt - processing["end"], "events": len(calls), "gap": max(gaps),
+                    "locks": next(CountingLock.acquisitions)}
+
+
+def run_wood(data, settings, seed):
+    "Returns the output of wood.py on the same g-code and settings"
+    with tempfile.TemporaryDirectory() as tmp:
+        name = os.path.join(tmp, "source.gcode")
+        with open(name, "w") as f:
+            f.write("".join(data))
+        options = []
+        for key, option in WOOD_OPTIONS.items():
+            options += [option, str(settings[key])]
+        # (the seed comes last, as --z-offset seeds the random generator too)
+        subprocess.check_call([sys.executable, WOOD, "--file", name] + options + ["--random-seed", seed],
+                              stdout=subprocess.DEVNULL)
+        with open(name) as f:
+            return f.read()
+
+
+def comparable(text, fixFirstLayer=False):
+    """
+    Returns the lines to compare: the plugin writes empty lines, and its temperatures as integers in the title of the
+    graph, and it drops the temperature changes before the first layer (but its own)
+    """
+    lines = [line.rstrip("\r") for line in text.split("\n")
+             if line.strip() and not line.startswith((";woodified", ";WoodGraph: Wood temperature graph"))]
+    if fixFirstLayer and ";LAYER:0" in lines:
+        firstLayer = lines.index(";LAYER:0")
+        lines = [line for index, line in enumerate(lines) if index > firstLayer or not line.startswith("M104 S")]
+    return lines
+
+
+def usage(myName):
+    print("Usage:")
+    print("  " + myName + " (--fixture gcodeFile) (--scales 1,4,16) (--seed integer) (--no-memory) (--no-compare)")
+    print("  " + myName + " (-f gcodeFile) (-s 1,4,16) (-r integer) (-m) (-c)")
+    sys.exit()
+
+
+if __name__ == "__main__":
+    opts, extraparams = getopt.getopt(sys.argv[1:], 'f:s:r:mch',
+                                      ['fixture=', 'scales=', 'seed=', 'no-memory', 'no-compare', 'help'])
+    fixture = os.path.join(HERE, "wood_cylinder_source.gcode")
+    scales = [1, 4, 16]
+    seed = "1"
+    memory = True
+    compare = True
+    for o, p in opts:
+        if o in ['-f', '--fixture']:
+            fixture = p
+        elif o in ['-s', '--scales']:
+            scales = [int(v) for v in p.split(",")]
+        elif o in ['-r', '--seed']:
+            seed = p
+        elif o in ['-m', '--no-memory']:
+            memory = False
+        elif o in ['-c', '--no-compare']:
+            compare = False
+        elif o in ['-h', '--help']:
+            usage(inspect.stack()[0][1])
+
+    plugin = load_plugin()
+    print("%6s %8s %7s | %7s %9s %9s | %8s %8s | %7s %9s %7s | %s"
+          % ("scale", "lines", "MB", "seconds", "lines/s", "thread/s", "peak MB", "locks",
+             "events", "max gap", "late", "same as wood.py"))
+    failed = False
+    for scale in scales:
+        data = cura_data(fixture, scale)
+        lines = sum(layer.count("\n") for layer in data)
+        size = sum(len(layer) for layer in data) / 1e6
+        output, measures = run_plugin(plugin, data, seed)
+        if output is None:
+            failed = True
+            print("%6i %8i %7.2f | %s" % (scale, lines, size, measures["error"]))
+            continue
+        peak = None
+        if memory:
+            tracemalloc.start()
+            if run_plugin(plugin, data, seed)[0] is not None:  # (slower, so it may fail where the first run did not)
+                peak = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        same = "-"
+        if compare:
+            expected = comparable(run_wood(data, plugin.Woodgrain_Cura().settingValues, seed), True)
+            got = comparable("".join(output), True)
+            same = "yes"
+            if got != expected:
+                failed = True
+                index = next((i for i, (a, b) in enumerate(zip(got, expected)) if a != b), min(len(got), len(expected)))
+                same = "NO, line %i: %r instead of %r" % (index + 1, (got + [""])[index], (expected + [""])[index])
+        print("%6i %8i %7.2f | %7.2f %9.0f %9.0f | %8s %8i | %7i %7.0fms %6.2fs | %s"
+              % (scale, lines, size, measures["seconds"], lines / measures["seconds"], lines / measures["processing"],
+                 "-" if peak is None else "%.1f" % peak, measures["locks"], measures["events"],
+                 measures["gap"] * 1000, measures["late"], same))
+    sys.exit(1 if failed else 0)
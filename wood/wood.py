@@ -13,6 +13,7 @@
 #Param: skipStartZ(float:0) Skip some Z at start of print, i.e. raft height (mm)
 #Param: scanForZHop(int:5) G-code lines to scan ahead for Z-Hop. Max 5 (default), 0 to disable.
 #Param: tempCommand(string: M104) In case you want to rely on M109 for example (pause until temperature settles down)
+#Param: spiralGrid(float:0) Z step of changes in spiral (vase mode) prints, 0 to detect them, negative to disable (mm)
 
 __copyright__ = "Copyright (C) 2012-2017 Jeremie@Francois.gmail.com"
 __author__ = 'Jeremie Francois (jeremie.francois@gmail.com)'
@@ -25,7 +26,21 @@ import math
 import datetime
 import inspect
 import sys
+import os
 import getopt
+import collections
+import multiprocessing
+import itertools
+import gzip
+import bz2
+import lzma
+import struct
+import zlib
+import mmap
+import threading
+import io
+import queue
+import time
 
 
 ############ BEGIN CURA PLUGIN STAND-ALONIFICATION ############
@@ -40,8 +55,48 @@ import getopt
 #   wood_standalone.py --min minTemp --max maxTemp --grain grainSize --file gcodeFile
 # It will "patch" your gcode file with the appropriate M104 temperature change.
 #
+# Compressed files (.gz, .bz2, .xz) and binary g-code (.bgcode) are processed as is. Use --output to write
+# elsewhere than in place, and --compress (gz, bz2, xz, bgcode or none) with --compress-level to choose the
+# output compression.
+#
+# Use --jobs to process a big file with several processes (the output is the same).
+#
+# Use --live to write the patched g-code to the standard output as it is being made, e.g. for a print server to
+# send the first lines to the printer at once. The moves along Z are found by a quick pre-scan of the file, or only
+# the height of the print is used with --normalize header (then the start does not depend on the size of the file,
+# but the temperatures may slightly differ). The height is read from the slicer comments or the graph of a former
+# run, at the top or the end of the file, and the file is scanned anyway when it does not match the last moves.
+#
+# Use --sweep to compare several textures before patching anything: --grain, --z-offset, --spikiness-power and
+# --random-seed then accept comma-separated values, and each combination is summed up on one line (temperature
+# range, number of dark bands and a compact profile along Z), with the options that produce it (a random seed is
+# picked when none is given).
+#
+# Use --index to keep what is found about the source file (the Z of the moves, the end of lines and the slicer
+# settings) in a sidecar file, so that running again on the same source (with --output) skips these passes.
+#
+# Use --z-range fromZ:toZ or --layers first:last (layers are the distinct heights of the moves, counted from 0) to
+# write only a slice of the print, e.g. to resume a failed print: the slice is found through the index (see --index,
+# it is made when missing), and its temperatures continue exactly as in a whole run. Either side may be left empty.
+#
+# Use --follow to process the file while the slicer is still writing it (like `tail -f`), with --output or --live:
+# it is complete once it has not grown for --follow-idle seconds (5 by default). With a plain --output file, the
+# temperatures are left as placeholders, and the output is copied once more at the end with them, when the whole print
+# is known: it is the same as a normal run. Else the height of the print must be in the slicer header (as with
+# --normalize header), or the end of the file is waited for, and the temperatures may differ from a normal run (more
+# so with --max-upward or --max-downward, e.g. the start lift gets no temperature change).
+#
+# Use --checksum to write each command with a line number and a checksum (N123 G1 X2*45), the way hosts send them
+# over serial lines, so that they can pass the lines through as they are. --strip-comments removes the comments.
+#
+# Spiral (vase mode) prints, where Z rises a little with every move, are detected from the slicer settings: their
+# temperature then changes at most once per 0.1mm step of Z. Use --spiral-grid to choose that step (or a negative
+# value to handle the file as any other).
+#
 
-# TODO: support  UTF8 for both python3 and 2, e.g. open(filename, "r", encoding="utf_8")
+# The g-code is handled as bytes: lines that are not changed are never decoded (whatever the encoding of their
+# comments), and the end of lines of the file (\n or \r\n) is kept.
+#
 
 def plugin_standalone_usage(myName):
     print("Usage:")
@@ -51,18 +106,38 @@ def plugin_standalone_usage(myName):
     print("  " + myName
           + " -f gcodeFile (-i minTemp) (-a maxTemp) (-t startTemp) (-g grainSize) (-u deltaTemp) (-r randomSeed)"
           + " (-s spikinessFactor) (-z zOffset)")
+    print("  (--output outputFile) (--compress gz|bz2|xz|bgcode|none) (--compress-level integer) (--jobs processCount)")
+    print("  (--live (--normalize scan|header)) (--sweep) (--spiral-grid mm) (--index)")
+    print("  (--checksum) (--strip-comments) (--z-range fromZ:toZ | --layers first:last) (--follow (--follow-idle s))")
     print("Licensed under CC-BY " + __date__[7:26] + " by jeremie.francois@gmail.com (www.tridimake.com)")
     sys.exit()
 
 
 try:
     filename
+    outputFilename = ""
+    outputCodec = ""
+    outputLevel = None
+    jobs = 1
+    live = False
+    normalization = "scan"
+    sweep = False
+    useIndex = False
+    checksumLines = False
+    stripComments = False
+    zRange = None
+    layerRange = None
+    following = False
+    followIdle = 5.0
 except NameError:
     # Then we are called from the command line (not from cura)
     # trying len(inspect.stack()) > 2 would be less secure btw
-    opts, extraparams = getopt.getopt(sys.argv[1:], 'i:a:t:g:u:d:r:s:z:k:c:f:w:h',
+    opts, extraparams = getopt.getopt(sys.argv[1:], 'i:a:t:g:u:d:r:s:z:k:c:f:w:o:j:ln:h',
                                       ['min=', 'max=', 'first-temp=', 'grain=', 'max-upward=', 'max-downward=', 'random-seed=',
-                                       'spikiness-power=', 'z-offset=', 'skip-start-z=', 'scan-for-z-hop=', 'temp-command', 'file=', 'help'])
+                                       'spikiness-power=', 'z-offset=', 'skip-start-z=', 'scan-for-z-hop=', 'temp-command', 'file=',
+                                       'output=', 'compress=', 'compress-level=', 'jobs=', 'live', 'normalize=', 'sweep', 'spiral-grid=',
+                                       'index', 'checksum', 'strip-comments', 'z-range=', 'layers=', 'follow', 'follow-idle=',
+                                       'help'])
     minTemp = 190
     maxTemp = 240
     firstTemp = 0
@@ -76,6 +151,25 @@ except NameError:
     tempCommand = 'M104'
     waitTemp = False
     filename = ""
+    outputFilename = ""
+    outputCodec = ""
+    outputLevel = None
+    jobs = 1
+    live = False
+    normalization = "scan"
+    sweep = False
+    spiralGrid = 0
+    useIndex = False
+    checksumLines = False
+    stripComments = False
+    zRange = None
+    layerRange = None
+    following = False
+    followIdle = 5.0
+    grainSizes = [grainSize]
+    zOffsets = [zOffset]
+    spikinessPowers = [spikinessPower]
+    randomSeeds = [None]  # None keeps the random state set by the other options
     for o, p in opts:
         if o in ['-f', '--file']:
             filename = p
@@ -86,7 +180,8 @@ except NameError:
         elif o in ['-t', '--first-temp']:
             firstTemp = float(p)
         elif o in ['-g', '--grain']:
-            grainSize = float(p)
+            grainSizes = [float(v) for v in p.split(",")]
+            grainSize = grainSizes[0]
         elif o in ['-u', '--max-upward']:
             maxUpward = float(p)
         elif o in ['-d', '--max-downward']:
@@ -95,31 +190,70 @@ except NameError:
             skipStartZ = float(p)
         elif o in ['-z', '--z-offset']:
             random.seed(0)
-            zOffset = float(p)
+            zOffsets = [float(v) for v in p.split(",")]
+            zOffset = zOffsets[0]
         elif o in ['-c', '--scan-for-z-hop']:
             scanForZHop = int(p)
         elif o in ['-r', '--random-seed']:
+            randomSeeds = p.split(",")
             if p != 0:
-                random.seed(p)
+                random.seed(randomSeeds[0])
         elif o in ['-s', '--spikiness-power']:
-            spikinessPower = float(p)
-            if spikinessPower <= 0:
-                spikinessPower = 1.0
+            spikinessPowers = [float(v) if float(v) > 0 else 1.0 for v in p.split(",")]
+            spikinessPower = spikinessPowers[0]
         elif o in ['-w', '--temp-command']:
             tempCommand = p  # e.g. M109 in place of default M104, see https://www.simplify3d.com/support/articles/3d-printing-gcode-tutorial/#M104-M109
+        elif o in ['-o', '--output']:
+            outputFilename = p
+        elif o == '--compress':
+            outputCodec = p
+        elif o == '--compress-level':
+            outputLevel = int(p)
+        elif o in ['-j', '--jobs']:
+            jobs = int(p)
+        elif o in ['-l', '--live']:
+            live = True
+        elif o in ['-n', '--normalize']:
+            normalization = p
+        elif o == '--sweep':
+            sweep = True
+        elif o == '--spiral-grid':
+            spiralGrid = float(p)
+        elif o == '--index':
+            useIndex = True
+        elif o == '--checksum':
+            checksumLines = True
+        elif o == '--strip-comments':
+            stripComments = True
+        elif o == '--z-range':
+            zRange = [float(v) if v else None for v in p.split(":")]
+        elif o == '--layers':
+            layerRange = [int(v) if v else None for v in p.split(":")]
+        elif o == '--follow':
+            following = True
+        elif o == '--follow-idle':
+            followIdle = float(p)
     if not filename:
         plugin_standalone_usage(inspect.stack()[0][1])
+    if len(zRange or [0, 0]) != 2 or len(layerRange or [0, 0]) != 2:
+        plugin_standalone_usage(inspect.stack()[0][1])  # ranges are from:to, either side may be empty
+    if not sweep and max(len(grainSizes), len(zOffsets), len(spikinessPowers), len(randomSeeds)) > 1:
+        plugin_standalone_usage(inspect.stack()[0][1])  # lists of values are only for --sweep
+    if sweep and randomSeeds == [None]:
+        randomSeeds = [str(random.randrange(1 << 31))]  # printed as -r, so that each line can be run again
 
 
 #
 ############ END CURA PLUGIN STAND-ALONIFICATION ############
 
 
+numberRegex = re.compile(rb'[0-9]+\.?[0-9]*')
+
+
 def get_value(gcode_line, key, default=None):
-    if not key in gcode_line or (';' in gcode_line and gcode_line.find(key) > gcode_line.find(';')):
+    if not key in gcode_line or (b';' in gcode_line and gcode_line.find(key) > gcode_line.find(b';')):
         return default
-    sub_part = gcode_line[gcode_line.find(key) + 1:]
-    m = re.search('^[0-9]+\.?[0-9]*', sub_part)
+    m = numberRegex.match(gcode_line, gcode_line.find(key) + 1)
     if m is None:
         return default
     try:
@@ -128,14 +262,17 @@ def get_value(gcode_line, key, default=None):
         return default
 
 
+# G0 and G1 "move" commands along Z, i.e. get_value(line, b'Z') when get_value(line, b'G') is 0 or 1, in one go.
+# It also works on large chunks of lines with findall().
+moveZRegex = re.compile(rb'^(?!;WoodGraph:)[^G;\n]*G0*[01](?:\.0*)?(?![0-9.])[^Z;\n]*Z([0-9]+\.?[0-9]*)', re.M)
+
+
 def get_z(line, default=None):
     # Support G0 and G1 "move" commands
-    if line.startswith(";WoodGraph:"):
-        return default
-    if get_value(line, 'G') == 0 or get_value(line, 'G') == 1:
-        return get_value(line, 'Z', default)
-    else:
+    m = moveZRegex.match(line)
+    if m is None:
         return default
+    return float(m.group(1))
 
 
 try:
@@ -233,171 +370,1394 @@ class Perlin:
         return value / total_amplitude
 
 
-with open(filename, "r") as f:
-    lines = f.readlines()
+# Binary g-code (.bgcode) is a file header followed by blocks, each made of a header, parameters, data and a CRC32.
+# Only the g-code blocks are unpacked, metadata and thumbnail blocks are passed through to the output.
+BGCODE_GCODE_BLOCK = 1
+BGCODE_THUMBNAIL_BLOCK = 5
+BGCODE_MAX_BLOCK_SIZE = 65535
+MEATPACK_CHARS = "0123456789. \nGX"  # 4-bit codes, 0b1111 announces a full character
+MEATPACK_G_PARAMETERS = "XYZEFIJRPWHCA"  # spaces stripped by MeatPack are put back before those
+
+
+def heatshrink_decode(data, window_bits, lookahead_bits):
+    "Unpacks heatshrink (LZSS) data: a 1 bit announces a literal byte, a 0 bit a back reference"
+    out = bytearray()
+    state = [0, 0, 0]  # bit accumulator, bits in the accumulator, next byte index
+
+    def take(count):
+        acc, n, pos = state
+        while n < count:
+            if pos >= len(data):
+                return None
+            acc = (acc << 8) | data[pos]
+            pos += 1
+            n += 8
+        n -= count
+        state[0], state[1], state[2] = acc & ((1 << n) - 1), n, pos
+        return acc >> n
+
+    while True:
+        tag = take(1)
+        if tag is None:
+            break
+        if tag:
+            c = take(8)
+            if c is None:
+                break
+            out.append(c)
+        else:
+            index = take(window_bits)
+            count = take(lookahead_bits)
+            if index is None or count is None:
+                break  # padding of the last byte
+            start = len(out) - index - 1
+            count += 1
+            if index + 1 >= count:
+                out += out[start:start + count]
+            else:
+                for i in range(count):
+                    out.append(out[start + i])
+    return bytes(out)
+
+
+def meatpack_decode(data):
+    "Unpacks MeatPack data, where the most common g-code characters are packed by pairs in a byte"
+    out = []
+    packing = False
+    noSpaces = False
+    lineIsMove = False
+    inComment = False
+
+    def put(c):
+        nonlocal lineIsMove, inComment
+        if c == "\n":
+            lineIsMove = inComment = False
+        elif c == ";":
+            inComment = True
+        elif not inComment:
+            if out and out[-1] == "\n" or not out:
+                lineIsMove = (c == "G")
+            elif noSpaces and lineIsMove and c in MEATPACK_G_PARAMETERS and out[-1] != " ":
+                out.append(" ")
+        out.append(c)
+
+    i = 0
+    while i < len(data):
+        b = data[i]
+        if b == 0xFF and i + 2 < len(data) and data[i + 1] == 0xFF:  # signal
+            signal = data[i + 2]
+            i += 3
+            if signal == 251:
+                packing = True
+            elif signal == 250:
+                packing = False
+            elif signal == 247:
+                noSpaces = True
+            elif signal == 246:
+                noSpaces = False
+            elif signal == 249:
+                packing = noSpaces = False
+            continue
+        i += 1
+        if not packing:
+            put(chr(b))
+            continue
+        for nibble in (b & 0xF, b >> 4):
+            if nibble == 0xF:
+                put(chr(data[i]))
+                i += 1
+            elif nibble == 11 and noSpaces:
+                put("E")
+            else:
+                put(MEATPACK_CHARS[nibble])
+    return "".join(out).encode("latin_1")  # (characters were made from bytes)
+
+
+def bgcode_blocks(f):
+    "Yields the (type, compression, uncompressed size, parameters, data) blocks of an opened binary g-code file"
+    magic, version, checksumType = struct.unpack('<4sIH', f.read(10))
+    if magic != b'GCDE':
+        raise ValueError("not a binary g-code file")
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            return
+        blockType, compression, size = struct.unpack('<HHI', head)
+        if compression:
+            head += f.read(4)
+            dataSize = struct.unpack('<I', head[8:])[0]
+        else:
+            dataSize = size
+        params = f.read(6 if blockType == BGCODE_THUMBNAIL_BLOCK else 2)
+        data = f.read(dataSize)
+        if checksumType == 1:
+            crc = struct.unpack('<I', f.read(4))[0]
+            if zlib.crc32(head + params + data) & 0xFFFFFFFF != crc:
+                raise ValueError("corrupted binary g-code block (bad CRC)")
+        yield blockType, compression, size, params, data
+
+
+def bgcode_unpack(compression, params, data):
+    "Returns the plain content of a block"
+    if compression == 1:
+        data = zlib.decompress(data)
+    elif compression in (2, 3):
+        data = heatshrink_decode(data, 11 if compression == 2 else 12, 4)
+    if struct.unpack('<H', params[:2])[0]:  # g-code encoded with MeatPack (with or without comments)
+        data = meatpack_decode(data)
+    return data
+
+
+class BinaryGcode:
+    "Reads (as lines) or writes the g-code of a binary g-code file, like a binary file object"
+
+    def __init__(self, name, mode="r", compresslevel=None, source=None):
+        self.writing = 'w' in mode
+        self.level = -1 if compresslevel is None else int(compresslevel)
+        self.pending = []
+        self.pendingSize = 0
+        self.blocks = None
+        self.file = open(name, "wb" if self.writing else "rb")
+        if self.writing:
+            self.file.write(struct.pack('<4sIH', b'GCDE', 1, 1))
+            if source and detect_codec(source) == 'bgcode':
+                with open(source, "rb") as f:
+                    for blockType, compression, size, params, data in bgcode_blocks(f):
+                        if blockType == BGCODE_GCODE_BLOCK:
+                            continue
+                        if not compression and blockType != BGCODE_THUMBNAIL_BLOCK:
+                            compression, data = 1, zlib.compress(data, self.level)
+                        self.write_block(blockType, compression, size, params, data)
+            else:
+                for blockType in (3, 4, 2):  # printer, print and slicer metadata are expected before the g-code
+                    self.write_block(blockType, 0, 0, struct.pack('<H', 0), b'')
+
+    def write_block(self, blockType, compression, size, params, data):
+        head = struct.pack('<HHI', blockType, compression, size)
+        if compression:
+            head += struct.pack('<I', len(data))
+        self.file.write(head + params + data)
+        self.file.write(struct.pack('<I', zlib.crc32(head + params + data) & 0xFFFFFFFF))
+
+    def read(self, size=-1):
+        "Returns the g-code of the next g-code block (whatever the size), or empty bytes at the end"
+        if self.blocks is None:
+            self.blocks = bgcode_blocks(self.file)
+        for blockType, compression, blockSize, params, data in self.blocks:
+            if blockType == BGCODE_GCODE_BLOCK:
+                return bgcode_unpack(compression, params, data)
+        return b""
+
+    def __iter__(self):
+        rest = b""
+        while True:
+            data = self.read()
+            if not data:
+                break
+            lines = io.BytesIO(rest + data).readlines()
+            rest = lines.pop() if not lines[-1].endswith(b"\n") else b""
+            for line in lines:
+                yield line
+        if rest:
+            yield rest
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.pendingSize >= BGCODE_MAX_BLOCK_SIZE:
+            self.flush_blocks(False)
+
+    def flush_blocks(self, final):
+        data = b"".join(self.pending)
+        while len(data) >= BGCODE_MAX_BLOCK_SIZE or (final and data):
+            cut = data.rfind(b"\n", 0, BGCODE_MAX_BLOCK_SIZE) + 1 or BGCODE_MAX_BLOCK_SIZE
+            if len(data) <= BGCODE_MAX_BLOCK_SIZE and final:
+                cut = len(data)
+            block = data[:cut]
+            self.write_block(BGCODE_GCODE_BLOCK, 1, len(block), struct.pack('<H', 0), zlib.compress(block, self.level))
+            data = data[cut:]
+        self.pending = [data]
+        self.pendingSize = len(data)
+
+    def close(self):
+        if self.writing:
+            self.flush_blocks(True)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Compressed g-code files: (codec name, magic bytes, file extension, opener)
+gcodeCodecs = [('gz', b'\x1f\x8b', '.gz', gzip.open),
+               ('bz2', b'BZh', '.bz2', bz2.open),
+               ('xz', b'\xfd7zXZ\x00', '.xz', lzma.open),
+               ('bgcode', b'GCDE', '.bgcode', BinaryGcode)]
+
+
+def detect_codec(name):
+    "Returns the compression codec of a g-code file from its magic bytes (or extension when empty), None if plain"
+    head = b''
+    if os.path.isfile(name):
+        with open(name, "rb") as f:
+            head = f.read(6)
+    for codec, magic, ext, opener in gcodeCodecs:
+        if head.startswith(magic) or (not head and name.lower().endswith(ext)):
+            return codec
+    return None
+
+
+def open_gcode(name, mode="r", codec=None, level=None, source=None):
+    """
+    Opens a plain, compressed or binary g-code file as a binary stream (g-code is handled as bytes, so that nothing
+    is decoded nor changed behind our back), compressed files are streamed (never fully in memory). When writing
+    binary g-code, the metadata blocks of the source file are kept.
+    """
+    if codec == 'bgcode':
+        return BinaryGcode(name, mode, level, source)
+    for c, magic, ext, opener in gcodeCodecs:
+        if c == codec:
+            if 'w' in mode and level is not None:
+                if c == 'xz':
+                    return opener(name, mode + "b", preset=int(level))
+                return opener(name, mode + "b", compresslevel=int(level))
+            return opener(name, mode + "b")
+    return open(name, mode + "b")
+
+# I/O pipeline: a thread reads the source by large chunks while lines are processed, and another one writes the
+# output by large chunks. The queues are bounded, so that a slow side holds the other back.
+PIPELINE_CHUNK = 1 << 20  # bytes
+PIPELINE_DEPTH = 8  # chunks
+
+
+def pipelined_chunks(f):
+    "Yields the lines of an opened file by lists (one per chunk), read ahead by a thread"
+    chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+    stop = threading.Event()
+
+    def reader():
+        try:
+            rest = b""
+            while not stop.is_set():
+                data = f.read(PIPELINE_CHUNK)
+                if not data:
+                    break
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                rest = data[cut:]
+                if cut:
+                    put(io.BytesIO(data[:cut]).readlines())  # lines keep their own end (\n or \r\n)
+            if rest:
+                put([rest])
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        thread.join()
+
+
+class PipelinedWriter:
+    "Gathers what is written in large chunks, that a thread writes to the underlying file while processing goes on"
+
+    def __init__(self, f):
+        self.file = f
+        self.buffer = []
+        self.size = 0
+        self.error = None
+        self.chunks = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writer(self):
+        while True:
+            data = self.chunks.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.file.write(data)
+                except Exception as e:
+                    self.error = e  # reported on close
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= PIPELINE_CHUNK:
+            self.chunks.put(b"".join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        if self.buffer:
+            self.chunks.put(b"".join(self.buffer))
+            self.buffer = []
+        self.chunks.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+#
+# Follow mode (--follow): the source is read as the slicer writes it, and taken as complete once it has not grown for
+# followIdle seconds. As the normalization needs the whole print, the temperature commands are then written as
+# placeholders and the output is copied once more at the end, with them (see fixed_up_temperatures()), or the height
+# of the print is read in the slicer header.
+#
+FOLLOW_POLL = 0.2  # seconds
+FOLLOW_HEAD = 65536  # bytes, as read by the analysis of the head of the file
+FOLLOW_TOP_TOLERANCE = 0.0005  # mm, as the height of the header may be computed (layer count * layer height)
+
+
+def wait_for_source(size):
+    "Waits until the source holds that many bytes, or has not grown for followIdle seconds"
+    lastSize = None
+    idleSince = time.time()
+    while True:
+        current = os.path.getsize(filename) if os.path.isfile(filename) else -1
+        if current >= size:
+            return
+        if current != lastSize:
+            lastSize = current
+            idleSince = time.time()
+        elif current >= 0 and time.time() - idleSince >= followIdle:
+            return
+        time.sleep(FOLLOW_POLL)
+
+
+def followed_lines():
+    "Streams the lines of the source as it grows, until it has not grown for followIdle seconds"
+    with open(filename, "rb") as f:
+        rest = b""
+        idleSince = time.time()
+        while True:
+            data = f.read(PIPELINE_CHUNK)
+            if data:
+                idleSince = time.time()
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                rest = data[cut:]
+                for line in io.BytesIO(data[:cut]).readlines():
+                    yield line
+            elif time.time() - idleSince < followIdle:
+                time.sleep(FOLLOW_POLL)
+            else:
+                break
+        if rest:
+            yield rest
+
+
+if following:
+    wait_for_source(FOLLOW_HEAD)
+inputCodec = detect_codec(filename)
+if following and (inputCodec is not None or not (outputFilename or live)):
+    sys.stderr.write("Following needs a plain source, and --output or --live\n")
+    sys.exit(1)
+# A slice is found and resumed through the index: the source must be seekable, and must not be patched in place
+slicing = (zRange is not None or layerRange is not None) and not sweep and not following
+if slicing:
+    if inputCodec == 'bgcode' or not (outputFilename or live):
+        sys.stderr.write("Slices need a plain or compressed source, and --output or --live\n")
+        sys.exit(1)
+    useIndex = True
+    normalization = "scan"
+    jobs = 1
+if not outputFilename:
+    outputFilename = filename  # patch in place
+if not outputCodec:
+    outputCodec = inputCodec if outputFilename == filename else detect_codec(outputFilename)
+# (a plain output file can be fixed up at the end, when the source is followed)
+fixingUp = following and not live and outputCodec is None and not (checksumLines or stripComments)
+if following:
+    jobs = 1
+    sweep = False
+    useIndex = False
+
+lines = None  # only loaded in memory by the parallel mode
+
+
+def gcode_lines():
+    "Streams the lines of the source g-code file, so that big (or compressed) files are never fully loaded"
+    if lines is not None:
+        for line in lines:
+            yield line
+        return
+    if following:
+        for line in followed_lines():
+            yield line
+        return
+    with open_gcode(filename, "r", inputCodec) as f:
+        chunks = pipelined_chunks(f)
+        try:
+            for chunk in chunks:
+                for line in chunk:
+                    yield line
+        finally:
+            chunks.close()
+
+
+def with_lookahead(source, count):
+    "Yields each line along with a window holding it and the (count - 1) next lines"
+    window = collections.deque()
+    for line in source:
+        window.append(line)
+        if len(window) == count:
+            yield window[0], window
+            window.popleft()
+    while window:
+        yield window[0], window
+        window.popleft()
+
+
+scanForZHop = int(scanForZHop)  # fix unicode error when using in range
+if scanForZHop > 5:
+    scanForZHop = 5
+
+
+def z_hop_scan_ahead(window, z):
+    if scanForZHop == 0:
+        return False  # Do not scan ahead
+    for checkLine in itertools.islice(window, scanForZHop):
+        checkZ = get_z(checkLine, z)
+        if checkZ < z:
+            return True  # Found z-hop
+    return False  # Did not find z-hop
+
+
+#
+# Parallel mode: the file is split in shards at layer changes, that a pool of processes tokenizes and then rebuilds.
+# Only the sequential state (current Z, postponed temperature changes...) is replayed serially, on the few lines
+# that matter. The output is the same as in the serial mode.
+#
+def shard_bounds(count):
+    "Returns the (start, end) line indexes of about count shards, each starting at a move along Z"
+    bounds = []
+    start = 0
+    step = max(1, len(lines) // count)
+    index = step
+    while index < len(lines):
+        if get_z(lines[index]) is None:
+            index += 1
+            continue
+        bounds.append((start, index))
+        start = index
+        index += step
+    bounds.append((start, len(lines)))
+    return bounds
+
+
+def scan_shard(bounds):
+    """
+    Worker: returns the (index, kind, z, zHop) events of the lines of a shard that matter to the serial pass.
+    Kinds are '' for moves, 'x' for extruder settings, 'k' for remarks to keep,
+    'w' for a former woodified header, 'g' for a former graph line and 'm' for a former temperature command.
+    """
+    start, end = bounds
+    events = []
+    for index in xrange(start, end):
+        line = lines[index]
+        lower = line.lower()
+        if b"; set extruder " in lower:
+            kind = 'x'
+        elif b"; M104_M109" in line:
+            kind = 'k'
+        elif b";woodified" in lower:
+            kind = 'w'
+        elif b";woodgraph" in lower:
+            kind = 'g'
+        elif b"m104" in lower:
+            kind = 'm'
+        else:
+            kind = ''
+        z = get_z(line)
+        if kind or z is not None:
+            events.append((index, kind, z, z is not None and z_hop_scan_ahead(lines[index:index + scanForZHop], z)))
+    return events
+
+
+def render_shard(job):
+    "Worker: rebuilds the output of a shard, given the lines to drop and the commands to insert before or after lines"
+    start, end, before, dropped, after = job
+    out = []
+    for index in sorted(set(before) | dropped | set(after)):
+        out.extend(lines[start:index])
+        if index in before:
+            out.append(before[index])
+        if index not in dropped:
+            out.append(lines[index])
+        if index in after:
+            out.append(after[index])
+        start = index + 1
+    out.extend(lines[start:end])
+    return b"".join(out)
+
+
+events = None
+pool = None
+if jobs > 1 and not live and "fork" in multiprocessing.get_all_start_methods():
+    lines = list(gcode_lines())
+    pool = multiprocessing.get_context("fork").Pool(jobs)  # workers share the lines loaded above
+    shards = shard_bounds(jobs * 4)
+    events = []
+    for shardEvents in pool.map(scan_shard, shards):
+        events.extend(shardEvents)
+elif sweep:
+    lines = list(gcode_lines())
+    shards = [(0, len(lines))]
+    events = scan_shard(shards[0])
+
+
+def z_moves():
+    "Yields the Z of each move along Z of the source file"
+    if events is not None:
+        for index, kind, z, zHop in events:
+            if z is not None:
+                yield z
+    elif gcodeIndex is not None:
+        for z in gcodeIndex['z']:
+            yield z
+    else:
+        for z in scan_z():
+            yield z
+
+
+def scan_z():
+    "Yields the Z of each move along Z of the source file, as get_z() would, but by large chunks"
+    rest = b""
+    with open_gcode(filename, "r", inputCodec) as f:
+        while True:
+            data = f.read(PIPELINE_CHUNK)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b"\n") + 1
+            rest = data[cut:]
+            for z in moveZRegex.findall(data, 0, cut):
+                yield float(z)
+    for z in moveZRegex.findall(rest):
+        yield float(z)
+
+
+TAIL_SIZE = 1 << 18  # bytes
+
+
+sourceEnds = None  # (head, tail) of the source, once read
+
+
+def gcode_ends():
+    """
+    Returns the head and the tail of the source g-code, read once for all the analyses below: plain seekable files
+    are seeked, others are unpacked through (once).
+    """
+    global sourceEnds
+    if sourceEnds is None:
+        with open_gcode(filename, "r", inputCodec) as f:
+            head = f.read(65536)
+            if inputCodec is None and f.seekable():
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - TAIL_SIZE))
+                tail = f.read()
+            else:
+                tail = head[-TAIL_SIZE:]
+                while True:
+                    data = f.read(PIPELINE_CHUNK)
+                    if not data:
+                        break
+                    tail = (tail + data)[-TAIL_SIZE:]
+        sourceEnds = head, tail
+    return sourceEnds
+
+
+def slicer_max_z(head, tail):
+    """
+    Returns the height of the print as announced in the head or the tail of the file (by the slicer, or by the graph
+    of a former run), when the highest move in the tail of the file confirms it and no move of the head (e.g. a lift
+    of the start script) goes higher. Else None, and the file must be scanned.
+    """
+    tail = tail[tail.find(b"\n") + 1:]  # (the first line may be cut)
+    tailZ = [float(z) for z in moveZRegex.findall(tail)]
+    headZ = [float(z) for z in moveZRegex.findall(head[:head.rfind(b"\n") + 1])]  # (the last line may be cut)
+    if not tailZ or max(headZ, default=0) > max(tailZ) + 0.0005:
+        return None
+    for z in slicer_heights(head, tail):
+        if abs(z - max(tailZ)) < 0.0005:
+            return max(tailZ)  # as scanned
+    return None
+
+
+def slicer_heights(head, tail):
+    "Returns the heights of the print announced in the head and the tail of the file, head first"
+    candidates = []
+    for text in (head, tail):
+        candidates += re.findall(rb'^;MAXZ:\s*([0-9.]+)', text, re.M)  # Cura
+        candidates += re.findall(rb'^;\s*max_layer_z\s*=\s*([0-9.]+)', text, re.M)  # PrusaSlicer
+    candidates += re.findall(rb'^;WoodGraph: Z ([0-9.]+)', tail, re.M)[-1:]  # former run, last layer
+    count = re.search(rb'^;\s*Layer[ _]count:\s*([0-9]+)', head, re.M | re.I)
+    height = re.search(rb'Layer height:\s*([0-9.]+)', head, re.I)
+    if count and height:
+        candidates.append(int(count.group(1)) * float(height.group(1)))
+    return [float(z) for z in candidates]
+
+
+SPIRAL_SETTINGS = rb'magic_spiralize = True|^;\s*spiral_vase\s*=\s*1|^;\s*spiralVaseMode,1'  # Cura, Prusa, S3D
+
+
+def spiral_vase(head, tail):
+    "Tells whether the slicer settings, at the top or the end of the file, enable the spiral (vase) mode"
+    return re.search(SPIRAL_SETTINGS, head + b"\n" + tail, re.M) is not None
+
+
+def detect_eol():
+    "Returns the end of line of the first line of the source file, so that the lines we add are consistent with it"
+    with open_gcode(filename, "r", inputCodec) as f:
+        head = f.read(65536)
+    return "\r\n" if head[:head.find(b"\n") + 1].endswith(b"\r\n") else "\n"
+
+
+#
+# With --index, what the passes above find is kept in a binary sidecar file (gcodeFile.gcidx) that later runs on the
+# same source memory-map instead of analysing it again. An index is only valid for the size, modification time and
+# hash (of the head and the tail) of the source it was made from, and it is removed when a file is written over it
+# (e.g. the source patched in place). See analysis/gcodeindex.py for its layout.
+#
+INDEX_MAGIC = b'GCIX'
+INDEX_VERSION = 1
+# magic, version, crlf, spiral, size, mtime (ns), hash, maxZ, slicer maxZ (0 if unknown), count of Z
+INDEX_HEADER = struct.Struct('<4sHBBQqIddI')
+INDEX_HASH_SPAN = 1 << 20  # bytes hashed at each end of the source
+
+
+def index_key():
+    "Returns the (size, modification time, hash) of the source file, that its index must match"
+    stat = os.stat(filename)
+    with open(filename, "rb") as f:
+        digest = zlib.crc32(f.read(INDEX_HASH_SPAN))
+        f.seek(max(INDEX_HASH_SPAN, stat.st_size - INDEX_HASH_SPAN))
+        digest = zlib.crc32(f.read(), digest)
+    return stat.st_size, stat.st_mtime_ns, digest
+
+
+def read_index():
+    "Returns the memory-mapped index of the source file, or None when there is none or when it is stale"
+    try:
+        with open(filename + ".gcidx", "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError):
+        return None
+    if len(data) < INDEX_HEADER.size or sys.byteorder != "little":
+        return None
+    magic, version, crlf, spiral, size, mtime, digest, maxZ, slicerMaxZ, count = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or (size, mtime, digest) != indexKey \
+            or len(data) != INDEX_HEADER.size + 17 * count:
+        return None
+    view = memoryview(data)[INDEX_HEADER.size:]
+    return {'eol': "\r\n" if crlf else "\n", 'spiral': bool(spiral), 'maxZ': maxZ, 'slicerMaxZ': slicerMaxZ or None,
+            'z': view[:8 * count].cast('d'), 'offset': view[8 * count:16 * count].cast('Q'), 'hop': view[16 * count:]}
+
+
+def write_index():
+    """
+    Analyses the source file and writes its index: the successive Z of the moves (without repeats), the offset of the
+    first of these moves in the (unpacked) file, whether this Z is only a hop (the next one goes back), and metadata
+    """
+    zs = []
+    offsets = []
+    base = 0
+    rest = b""
+    with open_gcode(filename, "r", inputCodec) as f:
+        while True:
+            data = f.read(PIPELINE_CHUNK)
+            final = not data
+            data = rest + data
+            cut = len(data) if final else data.rfind(b"\n") + 1
+            for m in moveZRegex.finditer(data, 0, cut):
+                z = float(m.group(1))
+                if not zs or zs[-1] != z:
+                    zs.append(z)
+                    offsets.append(base + m.start())
+            if final:
+                break
+            base += cut
+            rest = data[cut:]
+    hops = bytes(1 if 0 < i < len(zs) - 1 and zs[i - 1] < zs[i] and zs[i + 1] == zs[i - 1] else 0
+                 for i in range(len(zs)))
+    with open(filename + ".gcidx.tmp", "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, detect_eol() == "\r\n", spiral_vase(*gcode_ends()),
+                                  *indexKey, max(zs, default=0), slicer_max_z(*gcode_ends()) or 0, len(zs)))
+        f.write(struct.pack('<%id' % len(zs), *zs))
+        f.write(struct.pack('<%iQ' % len(zs), *offsets))
+        f.write(hops)
+    os.replace(filename + ".gcidx.tmp", filename + ".gcidx")
+
+
+gcodeIndex = None
+if useIndex and events is None:
+    indexKey = index_key()
+    gcodeIndex = read_index()
+    if gcodeIndex is None:
+        write_index()
+        gcodeIndex = read_index()
 
 
 # Limit the number of changes for helicoidal/Joris slicing method
 minimumChangeZ = 0.1
 
-# Find the total height of the object (minus optional additional Z-hops)
+# Spiral (vase mode) prints rise a little with every move: their Z is then quantized on a grid of spiralGrid mm, so
+# that there is one layer per step of the grid, whose noise is interpolated in a table of the steps
+spiralGrid = float(spiralGrid)
+if spiralGrid == 0:
+    spiral = gcodeIndex['spiral'] if gcodeIndex is not None else spiral_vase(*gcode_ends())
+    spiralGrid = minimumChangeZ if spiral else -1
+
+# Either the moves along Z are scanned, or with --normalize header only the height of the print is found in the
+# head and tail of the file (then noises are normalized on a sampling of the Z range, and built as the lines come)
+noisesFromHeader = False
 maxZ = 0
-thisZ = 0
-eol = "#"
-for line in lines:
-    thisZ = get_z(line)
-    if thisZ is not None:
-        if maxZ < thisZ:
-            maxZ = thisZ
-    if eol == "#" and len(line) >= 2:  # detect existing EOL to stay consistent when we'll be adding our own lines
-        if line[-2] == "\r":  # windows...
-            eol = "\r\n"
-if eol == "#":
-    eol = "\n"  # uh oh empty file?
+if fixingUp:
+    maxZ = float("inf")  # known at the end
+elif following:
+    # only the head of the file is there: its height can not be checked against the last moves
+    with open_gcode(filename, "r", inputCodec) as f:
+        maxZ = (slicer_heights(f.read(FOLLOW_HEAD), b"") or [0])[0]
+    noisesFromHeader = maxZ > 0
+    if not noisesFromHeader:
+        sys.stderr.write("No height found in the slicer header, waiting for the end of the file\n")
+        wait_for_source(float("inf"))
+        following = False
+if normalization == "header" and events is None and not following:
+    maxZ = (gcodeIndex['slicerMaxZ'] if gcodeIndex is not None else slicer_max_z(*gcode_ends())) or 0
+    noisesFromHeader = maxZ > 0
+    if not noisesFromHeader:
+        sys.stderr.write("No height found in the slicer comments, scanning the file\n")
+# to stay consistent when we'll be adding our own lines
+eol = gcodeIndex['eol'] if gcodeIndex is not None else detect_eol()
 
 "First pass generates the noise curve. We will normalize it as the user expects to reach the min & max temperatures"
 perlin = Perlin()
 
 
-def perlin_to_normalized_wood(z):
+def wood_fractal(z):
+    "Returns the smooth noise at some Z, before it is folded into bands"
     banding = 3
     octaves = 2
     persistence = 0.7
-    noise = banding * perlin.fractal(octaves, persistence, 0, 0, (z + zOffset) / (grainSize * 2));
+    return banding * perlin.fractal(octaves, persistence, 0, 0, (z + zOffset) / (grainSize * 2));
+
+
+def perlin_to_normalized_wood(z, noise=None):
+    if noise is None:
+        noise = wood_fractal(z)
     noise = (noise - math.floor(noise))  # normalized to [0,1]
     noise = math.pow(noise, spikinessPower)
     return noise
 
 
-# Generate normalized noises, and then temperatures (will be indexed by Z value)
+# Generate noises, and then temperatures (will be indexed by Z value)
 noises = {}
 # first value is hard encoded since some slicers do not write a Z0 at the first layer!
 noises[0] = perlin_to_normalized_wood(0)
 pendingNoise = None
-formerZ = -1
-for line in lines:
-    thisZ = get_z(line, formerZ)
+noiseFormerZ = -1
+spiralFractals = []  # smooth noise at each step of the spiral grid (it grows with the height)
+
+
+def layer_noise(z):
+    "Returns the noise of a layer, interpolated between the steps of the grid in spiral prints"
+    if spiralGrid <= 0:
+        return perlin_to_normalized_wood(z)
+    position = max(0.0, z) / spiralGrid
+    step = int(position)
+    while len(spiralFractals) < step + 2:
+        spiralFractals.append(wood_fractal(len(spiralFractals) * spiralGrid))
+    below = spiralFractals[step]
+    # (the smooth noise is interpolated, as its bands are not)
+    return perlin_to_normalized_wood(z, below + (position - step) * (spiralFractals[step + 1] - below))
+
 
-    if thisZ > 2 + formerZ:
-        formerZ = thisZ
+def track_noise(thisZ):
+    "Adds the noise of a new layer, when a move changes Z enough (or reaches another step of the spiral grid)"
+    global noiseFormerZ
+    if thisZ > 2 + noiseFormerZ:
+        noiseFormerZ = thisZ
     # noises = {}  # some damn slicers include a big negative Z shift at the beginning, which impacts the min/max range
-    elif abs(thisZ - formerZ) > minimumChangeZ and thisZ > skipStartZ:
-        formerZ = thisZ
-        noises[thisZ] = perlin_to_normalized_wood(thisZ)
+    elif thisZ > skipStartZ and (int(thisZ / spiralGrid) != int(noiseFormerZ / spiralGrid) if spiralGrid > 0
+                                 else abs(thisZ - noiseFormerZ) > minimumChangeZ):
+        noiseFormerZ = thisZ
+        noises[thisZ] = layer_noise(thisZ)
+
+
+if noisesFromHeader:
+    samples = [perlin_to_normalized_wood(0)]
+    z = max(skipStartZ, 0)
+    while z <= maxZ:
+        samples.append(layer_noise(z))
+        z += minimumChangeZ / 2
+    noisesMax = max(samples)
+    noisesMin = min(samples)
+elif not fixingUp:
+    # (and find the total height of the object, minus optional additional Z-hops, in the same pass)
+    for thisZ in z_moves():  # (lines without Z would not change anything)
+        if maxZ < thisZ:
+            maxZ = thisZ
+        track_noise(thisZ)
+    noisesMax = noises[max(noises, key=noises.get)]
+    noisesMin = noises[min(noises, key=noises.get)]
 
-# normalize built noises
-noisesMax = noises[max(noises, key=noises.get)]
-noisesMin = noises[min(noises, key=noises.get)]
-for z, v in noises.items():
-    noises[z] = (noises[z] - noisesMin) / (noisesMax - noisesMin)
+
+def normalized_noise(z):
+    "Returns the noise of a layer, normalized to [0,1] over the whole print"
+    return min(1, max(0, (noises[z] - noisesMin) / (noisesMax - noisesMin)))
 
 
 def noise_to_temp(noise):
     return minTemp + noise * (maxTemp - minTemp)
 
-scanForZHop = int(scanForZHop)  # fix unicode error when using in range
-if scanForZHop > 5:
-    scanForZHop = 5
 
+postponedTempDelta = 0  # only when maxUpward is used
+postponedTempLast = None  # only when maxUpward is used
+
+
+def layer_temp(z):
+    """
+    Returns the temperature of a new layer at height z, and the command to set it (empty for the first layer when
+    its temperature is forced). Changes capped by maxUpward or maxDownward are postponed to the next layers.
+    """
+    global postponedTempDelta, postponedTempLast
+    if firstTemp != 0 and z <= 0.5:  # if specified, keep the first temp for the first 0.5mm
+        return firstTemp, ""
+
+    temp = noise_to_temp(normalized_noise(z))
+
+    # possibly cap temperature change upward
+    temp += postponedTempDelta
+    postponedTempDelta = 0
+    if (postponedTempLast is not None)\
+            and (maxUpward > 0)\
+            and (temp > postponedTempLast + maxUpward ):
+        postponedTempDelta = temp - (postponedTempLast + maxUpward)
+        temp = postponedTempLast + maxUpward
+    if (postponedTempLast is not None)\
+            and (maxDownward > 0)\
+            and (temp < postponedTempLast - maxDownward ):
+        postponedTempDelta = postponedTempLast - maxDownward - temp
+        temp = postponedTempLast - maxDownward
+    if temp > maxTemp:
+        postponedTempDelta = 0
+        temp = maxTemp
+    postponedTempLast = temp
+
+    return temp, ("%s S%i" + eol) % (tempCommand, temp)
 
-def z_hop_scan_ahead(index, z):
-    if scanForZHop == 0:
-        return False  # Do not scan ahead
-    for i in range(scanForZHop):
-        checkZ = get_z(lines[index + i], z)
-        if checkZ < z:
-            return True  # Found z-hop
-    return False  # Did not find z-hop
+
+def graph_line(z, temp):
+    "Returns the ASCII-art graph line of a temperature change"
+    t = int(19 * (temp - minTemp) / (maxTemp - minTemp))
+    graphStr = ";WoodGraph: Z %03f " % z
+    graphStr += "@%3iC | " % temp
+    graphStr += '#'*t + '.'*(20 - t)
+    graphStr += eol
+    return graphStr
 
 
 #
-# Now save the file with the patched M104 temperature settings
+# Slices (--z-range, --layers): the bounds are found in the index. The state of woodify_lines() at the start of the
+# slice is rebuilt by replaying its layer changes on the Z of the index, where only the few lines of the Z-hop scan
+# are read (seeked), so that the temperatures (with their postponed changes) go on as in a whole run.
 #
-with open(filename, "w") as f:
-    # Prepare a transposed ASCII-art temperature graph for the end of the file
-
-    f.write(";woodified gcode, see graph at the end - jeremie.francois@gmail.com - generated on " +
-            datetime.datetime.now().strftime("%Y%m%d-%H%M") + eol)
-    warmingTempCommands = "M230 S0" + eol  # enable wait for temp on the first change
-    t = firstTemp
-    if t == 0:
-        t = noise_to_temp(0)
-    warmingTempCommands += ("%s S%i" + eol) % (tempCommand, t)
-    # The two following commands depends on the firmware:
-    warmingTempCommands += "M230 S1" + eol  # now disable wait for temp on the first change
-    warmingTempCommands += "M116" + eol  # wait for the temperature to reach the setting (M109 is obsolete)
-    f.write(warmingTempCommands)
-
-    graphStr = ";WoodGraph: Wood temperature graph (from " + str(minTemp) + "C to " + str(
-        maxTemp) + "C, grain size " + str(grainSize) + "mm, z-offset " + str(zOffset) + ", scanForZHop " + str(scanForZHop) + ")"
-    if skipStartZ:
-        graphStr += ", skipped first " + str(skipStartZ) + "mm of print"
-    if maxUpward:
-        graphStr += ", temperature increases capped at " + str(maxUpward)
-    if maxDownward:
-        graphStr += ", temperature decreases capped at " + str(maxDownward)
-    graphStr += ":"
-    graphStr += eol
+def slice_bounds():
+    "Returns the (start, end) offsets of the slice in the unpacked source (end is None up to its end), and its Z"
+    zs, offsets, hops = gcodeIndex['z'], gcodeIndex['offset'], gcodeIndex['hop']
+    fromZ, toZ = zRange or (None, None)
+    if layerRange is not None:
+        heights = sorted(set(z for z, hop in zip(zs, hops) if not hop))
+        first, last = layerRange
+        fromZ = None if first is None else heights[min(first, len(heights) - 1)]
+        toZ = None if last is None else heights[min(last, len(heights) - 1)]
+    # the slice starts after the last move below it, and ends after the last move up to its top
+    first = 0
+    last = len(zs)
+    for index in xrange(len(zs)):
+        if not hops[index]:
+            if fromZ is not None and zs[index] < fromZ - 0.0005:
+                first = index + 1
+            if toZ is not None and zs[index] <= toZ + 0.0005:
+                last = index + 1
+    start = 0 if first == 0 else offsets[first] if first < len(zs) else None
+    end = offsets[last] if last < len(zs) else None
+    if start is not None and end is not None and end <= start:
+        start = None  # empty
+    return start, end, fromZ, toZ
+
 
+def lines_at(f, offset, count):
+    "Returns count lines of an opened source from an offset (fewer at its end)"
+    f.seek(offset)
+    data = b""
+    while data.count(b"\n") < count:
+        more = f.read(4096)
+        if not more:
+            break
+        data += more
+    return io.BytesIO(data).readlines()[:count]
+
+
+def resume_state(start):
+    """
+    Replays the layer changes of woodify_lines() before an offset of the source, and returns its (thisZ, formerZ)
+    there with the temperature then set (None if none was)
+    """
     thisZ = -1
     formerZ = -1
-    warned = 0
+    temp = None
+    with open_gcode(filename, "r", inputCodec) as f:
+        for z, offset in zip(gcodeIndex['z'], gcodeIndex['offset']):
+            if offset >= start or thisZ == maxZ:
+                break
+            thisZ = z
+            if thisZ != formerZ and thisZ in noises \
+                    and not z_hop_scan_ahead(lines_at(f, offset, max(scanForZHop, 1)), thisZ):
+                temp = layer_temp(thisZ)[0]
+                formerZ = thisZ
+            if thisZ != maxZ:
+                thisZ = formerZ  # (as the next lines without Z would)
+    return thisZ, formerZ, temp
+
 
-    postponedTempDelta = 0  # only when maxUpward is used
-    postponedTempLast = None  # only when maxUpward is used
+def slice_lines(start):
+    "Streams the lines of the source from an offset (at the start of a line)"
+    with open_gcode(filename, "r", inputCodec) as f:
+        f.seek(start)
+        chunks = pipelined_chunks(f)
+        try:
+            for chunk in chunks:
+                for line in chunk:
+                    yield line
+        finally:
+            chunks.close()
+
+
+def count_lines(start, end):
+    "Returns the count of lines of the source between two offsets (at starts of lines)"
+    count = 0
+    with open_gcode(filename, "r", inputCodec) as f:
+        f.seek(start)
+        while start < end:
+            data = f.read(min(PIPELINE_CHUNK, end - start))
+            if not data:
+                break
+            count += data.count(b"\n")
+            start += len(data)
+    return count
+
+
+sliceState = (-1, -1)
+sliceCount = None  # lines of the slice, None up to the end
+if slicing:
+    sliceStart, sliceEnd, sliceFromZ, sliceToZ = slice_bounds()
+    resumedZ, resumedFormerZ, sliceTemp = resume_state(sliceStart if sliceStart is not None else float("inf"))
+    sliceState = (resumedZ, resumedFormerZ)
+    if sliceStart is None:
+        sliceCount = 0
+    elif sliceEnd is not None:
+        sliceCount = count_lines(sliceStart, sliceEnd)
+
+
+#
+# Now build the g-code with the patched M104 temperature settings
+#
+woodifiedHeader = (";woodified gcode, see graph at the end - jeremie.francois@gmail.com - generated on " +
+                   datetime.datetime.now().strftime("%Y%m%d-%H%M") + eol)
+warmingTempCommands = "M230 S0" + eol  # enable wait for temp on the first change
+t = firstTemp
+if t == 0:
+    t = noise_to_temp(0)
+if slicing and sliceTemp is not None:
+    t = sliceTemp  # the temperature in effect where the slice starts
+warmingTempCommands += ("%s S%i" + eol) % (tempCommand, t)
+# The two following commands depends on the firmware:
+warmingTempCommands += "M230 S1" + eol  # now disable wait for temp on the first change
+warmingTempCommands += "M116" + eol  # wait for the temperature to reach the setting (M109 is obsolete)
+
+# Prepare a transposed ASCII-art temperature graph for the end of the file
+graphStr = ";WoodGraph: Wood temperature graph (from " + str(minTemp) + "C to " + str(
+    maxTemp) + "C, grain size " + str(grainSize) + "mm, z-offset " + str(zOffset) + ", scanForZHop " + str(scanForZHop) + ")"
+if skipStartZ:
+    graphStr += ", skipped first " + str(skipStartZ) + "mm of print"
+if maxUpward:
+    graphStr += ", temperature increases capped at " + str(maxUpward)
+if maxDownward:
+    graphStr += ", temperature decreases capped at " + str(maxDownward)
+if slicing:
+    graphStr += ", slice from Z %s to Z %s" % (sliceFromZ, sliceToZ)
+graphStr += ":"
+graphStr += eol
+
+
+def woodify_lines(source, state=(-1, -1), count=None):
+    """
+    Yields the patched g-code, line by line. Only scanForZHop lines are read ahead (for the Z-hop scan), so that
+    the first lines come at once in live mode. A slice resumes from a (thisZ, formerZ) state, and stops after count
+    lines of the source (the Z-hop scan still reads after them).
+    """
+    global warmingTempCommands, graphStr
+    thisZ, formerZ = state
     skip_lines = 0
-    for index, line in enumerate(lines):
-        if "; set extruder " in line.lower():  # special fix for BFB
-            f.write(line)
-            f.write(warmingTempCommands)
+    for line, window in itertools.islice(with_lookahead(source, max(scanForZHop, 1)), count):
+        if noisesFromHeader or fixingUp:
+            lineZ = get_z(line)
+            if lineZ is not None:
+                track_noise(lineZ)
+                if lineZ > fixup['maxZ']:
+                    fixup['maxZ'] = lineZ
+        lower = line.lower()
+        if b"; set extruder " in lower:  # special fix for BFB
+            yield line
+            yield warmingTempCommands.encode()
             warmingTempCommands = ""
-        elif "; M104_M109" in line:
-            f.write(line)  # don't lose this remark!
+        elif b"; M104_M109" in line:
+            yield line  # don't lose this remark!
         elif skip_lines > 0:
             skip_lines -= 1
-        elif ";woodified" in line.lower():
+        elif b";woodified" in lower:
             skip_lines = 4  # skip 4 more lines after our comment
-        elif not ";woodgraph" in line.lower():  # forget optional former temp graph lines in the file
-            if thisZ == maxZ:
-                f.write(line)  # no more patch, keep the important end scripts unchanged
-            elif not "m104" in line.lower():  # forget any previous temp in the file
+        elif not b";woodgraph" in lower:  # forget optional former temp graph lines in the file
+            if thisZ == maxZ or (following and thisZ >= maxZ - FOLLOW_TOP_TOLERANCE):
+                yield line  # no more patch, keep the important end scripts unchanged
+            elif not b"m104" in lower:  # forget any previous temp in the file
                 thisZ = get_z(line, formerZ)
-                if thisZ != formerZ and thisZ in noises and not z_hop_scan_ahead(index, thisZ):
-
-                    if firstTemp != 0 and thisZ <= 0.5:  # if specified, keep the first temp for the first 0.5mm
-                        temp = firstTemp
+                # (when fixing up, the layers are only known at the end: each Z may become one)
+                if thisZ != formerZ and (fixingUp or thisZ in noises) and not z_hop_scan_ahead(window, thisZ):
+                    if fixingUp:
+                        placeholder = (("%s S000" + eol) % tempCommand).encode()
+                        fixups.append((fixup['offset'], len(placeholder), 't', thisZ))
+                        yield placeholder
                     else:
-                        temp = noise_to_temp(noises[thisZ])
-
-                        # possibly cap temperature change upward
-                        temp += postponedTempDelta
-                        postponedTempDelta = 0
-                        if (postponedTempLast is not None)\
-                                and (maxUpward > 0)\
-                                and (temp > postponedTempLast + maxUpward ):
-                            postponedTempDelta = temp - (postponedTempLast + maxUpward)
-                            temp = postponedTempLast + maxUpward
-                        if (postponedTempLast is not None)\
-                                and (maxDownward > 0)\
-                                and (temp < postponedTempLast - maxDownward ):
-                            postponedTempDelta = postponedTempLast - maxDownward - temp
-                            temp = postponedTempLast - maxDownward
-                        if temp > maxTemp:
-                            postponedTempDelta = 0
-                            temp = maxTemp
-                        postponedTempLast = temp
-
-                        f.write(("%s S%i" + eol) % (tempCommand, temp))
+                        temp, command = layer_temp(thisZ)
+                        if command:
+                            yield command.encode()
 
+                        # Build the corresponding graph line
+                        graphStr += graph_line(thisZ, temp)
                     formerZ = thisZ
+                if fixingUp and thisZ > fixup['top']:
+                    fixup['top'] = thisZ
+                    fixup['cut'] = len(fixups)
+
+                yield line
+            elif fixingUp:
+                fixups.append((fixup['offset'], len(line) + 1, 'm', None))
+                yield b";" + line
+
+
+fixups = []  # (output offset, size, kind, z) of what the follow mode writes before the whole print is known
+fixup = {'offset': 0, 'maxZ': 0, 'top': -1, 'cut': 0}  # output size, highest move, top of thisZ, fixups before it
+fixupEdits = []
 
-                    # Build the corresponding graph line
-                    t = int(19 * (temp - minTemp) / (maxTemp - minTemp))
-                    graphStr += ";WoodGraph: Z %03f " % thisZ
-                    graphStr += "@%3iC | " % temp
-                    graphStr += '#'*t + '.'*(20 - t)
-                    graphStr += eol
 
-                f.write(line)
+def fixed_up_temperatures():
+    """
+    Follow mode: computes the temperatures of the layer changes once the whole print is known, and returns the
+    (offset, size, bytes) edits of the output. Placeholders were written for the temperature commands, and the former
+    ones of the source were commented out: after the top of the print, where nothing is patched, the placeholders are
+    dropped and the former commands are put back. Placeholders were written at each new Z, and the layer changes
+    among them are found again as woodify_lines() does, now that all the layers are known.
+    """
+    global maxZ, noisesMin, noisesMax, graphStr
+    maxZ = fixup['maxZ']
+    noisesMax = noises[max(noises, key=noises.get)]
+    noisesMin = noises[min(noises, key=noises.get)]
+    cut = fixup['cut'] if fixup['top'] == maxZ else len(fixups)
+    edits = []
+    formerZ = -1
+    for index, (offset, size, kind, z) in enumerate(fixups):
+        if kind == 'm':
+            edits.append((offset, 1 if index >= cut else size, b""))
+        elif index >= cut or z == formerZ or z not in noises:
+            edits.append((offset, size, b""))
+        else:
+            temp, command = layer_temp(z)
+            graphStr += graph_line(z, temp)
+            edits.append((offset, size, command.encode()))
+            formerZ = z
+    return edits
+
+
+def edited_copy(sourceName, targetName, edits):
+    "Copies a file, replacing the size bytes at each offset of the (offset, size, bytes) edits, in the offsets order"
+    with open(sourceName, "rb") as f, open(targetName, "wb") as g:
+        position = 0
+        for offset, size, data in edits:
+            while position < offset:
+                chunk = f.read(min(PIPELINE_CHUNK, offset - position))
+                g.write(chunk)
+                position += len(chunk)
+            f.seek(size, os.SEEK_CUR)
+            position += size
+            g.write(data)
+        while True:
+            chunk = f.read(PIPELINE_CHUNK)
+            if not chunk:
+                break
+            g.write(chunk)
+
+
+def replay_events(layer):
+    """
+    Replays woodify_lines() on the events only (the lines in between are plain lines). Calls layer(z) on each
+    temperature change, and returns the commands to insert before and after lines, and the lines to drop.
+    """
+    global warmingTempCommands
+    thisZ = -1
+    formerZ = -1
+    skip_lines = 0
+    before = {}
+    after = {}
+    dropped = set()
+    lastIndex = -1
+    for index, kind, z, zHop in events + [(len(lines), None, None, False)]:
+        gap = index - lastIndex - 1
+        if gap > 0:
+            skipped = min(skip_lines, gap)
+            dropped.update(xrange(lastIndex + 1, lastIndex + 1 + skipped))
+            skip_lines -= skipped
+            if skipped < gap and thisZ != maxZ:
+                thisZ = formerZ
+        lastIndex = index
+        if kind is None:
+            break
+        if kind == 'x':
+            after[index] = warmingTempCommands.encode()
+            warmingTempCommands = ""
+        elif kind == 'k':
+            pass
+        elif skip_lines > 0:
+            skip_lines -= 1
+            dropped.add(index)
+        elif kind == 'w':
+            skip_lines = 4
+            dropped.add(index)
+        elif kind == 'g':
+            dropped.add(index)
+        elif thisZ == maxZ:
+            pass
+        elif kind == 'm':
+            dropped.add(index)
+        else:
+            thisZ = formerZ if z is None else z
+            if thisZ != formerZ and thisZ in noises and not zHop:
+                command = layer(thisZ)
+                if command:
+                    before[index] = command.encode()
+                formerZ = thisZ
+    return before, after, dropped
+
 
-    f.write(graphStr + eol)
+def woodify_shards():
+    "Yields the patched g-code of the parallel mode, shard by shard"
+
+    def layer(z):
+        global graphStr
+        temp, command = layer_temp(z)
+        graphStr += graph_line(z, temp)
+        return command
+
+    before, after, dropped = replay_events(layer)
+    shardJobs = []
+    for start, end in shards:
+        shardJobs.append((start, end,
+                          dict((i, c) for i, c in before.items() if start <= i < end),
+                          set(i for i in dropped if start <= i < end),
+                          dict((i, c) for i, c in after.items() if start <= i < end)))
+    for text in pool.map(render_shard, shardJobs):
+        yield text
+    pool.close()
+
+
+def woodified():
+    "Yields the whole patched g-code"
+    global warmingTempCommands
+    yield woodifiedHeader.encode()
+    yield warmingTempCommands.encode()
+    if events is not None:
+        for text in woodify_shards():
+            yield text
+    elif fixingUp:
+        fixup['offset'] = len(woodifiedHeader.encode()) + len(warmingTempCommands.encode())
+        for text in woodify_lines(gcode_lines()):
+            fixup['offset'] += len(text)
+            yield text
+        fixupEdits.extend(fixed_up_temperatures())
+    elif slicing:
+        if sliceStart:
+            warmingTempCommands = ""  # (a BFB start g-code that sets the extruder is before the slice)
+        if sliceCount != 0:
+            for text in woodify_lines(slice_lines(sliceStart), sliceState, sliceCount):
+                yield text
+    else:
+        for text in woodify_lines(gcode_lines()):
+            yield text
+    yield (graphStr + eol).encode()
+
+
+#
+# Sweep mode: the layer changes are found once, then each combination of parameters only recomputes the noises and
+# temperatures of those layers (in the pool of processes when there is one). Nothing is written.
+#
+changeZs = []
+basePerlin = perlin
+SWEEP_SHADES = " .:-=+*#%@"
+SWEEP_WIDTH = 48
+
+
+def sweep_profile(combo):
+    "Worker: returns the temperatures of the layer changes for a (grainSize, zOffset, spikinessPower, seed) combination"
+    global grainSize, zOffset, spikinessPower, perlin, noisesMin, noisesMax, postponedTempDelta, postponedTempLast
+    grainSize, zOffset, spikinessPower, seed = combo
+    perlin = basePerlin
+    if seed is not None:
+        random.seed(seed)
+        perlin = Perlin()
+    del spiralFractals[:]
+    layerZs = list(noises)
+    values = [layer_noise(z) for z in layerZs]  # the whole Z column at once
+    noises.update(zip(layerZs, values))
+    noisesMax = max(values)
+    noisesMin = min(values)
+    postponedTempDelta = 0
+    postponedTempLast = None
+    return [layer_temp(z)[0] for z in changeZs]
+
+
+def sweep_summary(combo, temps):
+    "Returns the table line of a combination"
+    grain, offset, spikiness, seed = combo
+    middle = (minTemp + maxTemp) / 2.0
+    bands = sum(1 for a, b in zip(temps, temps[1:]) if a < middle <= b)  # dark bands begin
+    profile = ""
+    for column in xrange(min(SWEEP_WIDTH, len(temps))):
+        t = temps[column * len(temps) // min(SWEEP_WIDTH, len(temps))]
+        shade = int((len(SWEEP_SHADES) - 1) * (t - minTemp) / (maxTemp - minTemp))
+        profile += SWEEP_SHADES[min(len(SWEEP_SHADES) - 1, max(0, shade))]
+    options = "-g %g -z %g -s %g" % (grain, offset, spikiness)
+    if seed is not None:
+        options += " -r %s" % seed  # last, as --z-offset resets the random seed
+    if not temps:
+        return "%-30s | no layer change" % options
+    return "%-30s | %4i %5.1f %5.1f %5.1f %5i | %s" % (options, len(temps), min(temps), sum(temps) / len(temps),
+                                                    max(temps), bands, profile)
+
+
+if sweep:
+    def sweep_layer(z):
+        changeZs.append(z)
+        return ""
+
+    replay_events(sweep_layer)
+    combos = list(itertools.product(grainSizes, zOffsets, spikinessPowers, randomSeeds))
+    if pool:
+        pool.close()
+        pool = multiprocessing.get_context("fork").Pool(jobs)  # a new pool, that knows the layer changes
+        profiles = pool.map(sweep_profile, combos)
+        pool.close()
+    else:
+        profiles = [sweep_profile(combo) for combo in combos]
+    print("Wood texture sweep of %s: %i combinations, from %gC to %gC, %i layer changes up to Z %g"
+          % (filename, len(combos), minTemp, maxTemp, len(changeZs), maxZ))
+    print("%-30s | %4s %5s %5s %5s %5s | %s" % ("options", "lays", "min", "mean", "max", "bands",
+                                                "profile along Z (bottom to top, darker is hotter)"))
+    for combo, temps in zip(combos, profiles):
+        print(sweep_summary(combo, temps))
+    sys.exit()
+
+#
+# With --checksum, each command gets a line number and a checksum (N<line> command*<checksum>) the way serial hosts
+# add them, after a line number reset (M110), so that a host can send the lines as they are. Comments that follow
+# commands are dropped from these lines. --strip-comments drops all the comments, and the empty lines.
+#
+def numbered_line(number, command):
+    "Returns a command with its line number and its checksum, as RepRap firmwares check them"
+    line = b"N%i %s" % (number, command)
+    checksum = 0
+    for c in line:
+        checksum ^= c
+    return b"%s*%i" % (line, checksum)
+
+
+def serial_lines(pieces):
+    "Yields the output as a serial host sends it (see above), piece by piece"
+    newline = eol.encode()
+    number = 0
+    if checksumLines:
+        yield numbered_line(number, b"M110 N0") + newline
+    for piece in pieces:
+        out = []
+        for line in piece.splitlines():
+            command = line.split(b";", 1)[0].strip()
+            if not command:
+                if not stripComments:
+                    out.append(line)
+            elif checksumLines:
+                number += 1
+                out.append(numbered_line(number, command))
+            else:
+                out.append(command)
+        if out:
+            yield newline.join(out) + newline
+
+
+output = serial_lines(woodified()) if checksumLines or stripComments else woodified()
+
+if live:
+    # Stream to the standard output as soon as lines are ready, e.g. for a print server that sends them to a printer
+    for text in output:
+        sys.stdout.buffer.write(text)
+        sys.stdout.buffer.flush()
+else:
+    # write aside, so that the source can be streamed while patching it in place
+    tmpFilename = outputFilename + ".tmp"
+    try:
+        with PipelinedWriter(open_gcode(tmpFilename, "w", outputCodec, outputLevel, filename)) as f:
+            for text in output:
+                f.write(text)
+        if fixupEdits:
+            edited_copy(tmpFilename, tmpFilename + ".fix", fixupEdits)
+            os.replace(tmpFilename + ".fix", tmpFilename)
+    except BaseException:
+        for name in (tmpFilename, tmpFilename + ".fix"):
+            if os.path.exists(name):
+                os.remove(name)
+        raise
+    os.replace(tmpFilename, outputFilename)
+    if os.path.exists(outputFilename + ".gcidx"):
+        os.remove(outputFilename + ".gcidx")  # (it described the file before, e.g. the source patched in place)